@@ -0,0 +1,43 @@
+'''
+Compares two sets of benchmark results written by benchmarks.run, by
+the best time of each benchmark.
+
+    python -m benchmarks.compare before.json after.json
+'''
+import argparse
+import json
+
+
+def key(result):
+    return result['name'], result['release'], result['threads']
+
+
+def label(result):
+    return result['name'] + (f' -j{result["threads"]}' if result['threads'] else '') + \
+        (f' [{result["release"]}]' if result['release'] else '')
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.compare')
+    parser.add_argument('baseline', help='the results to compare against')
+    parser.add_argument('results', help='the results to compare')
+    args = parser.parse_args()
+
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    with open(args.results) as results_file:
+        results = json.load(results_file)
+
+    print(f'{baseline["commit"]} -> {results["commit"]}')
+    before = {key(result): result for result in baseline['results']}
+    for result in results['results']:
+        old = before.get(key(result))
+        if old is None:
+            print(f'{label(result):<60} {"":>9}   {result["best"]:8.3f}s  (new)')
+            continue
+        change = (result['best'] - old['best']) / old['best'] * 100
+        print(f'{label(result):<60} {old["best"]:8.3f}s -> {result["best"]:8.3f}s  {change:+6.1f}%')
+
+
+if __name__ == '__main__':
+    main()
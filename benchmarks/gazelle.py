@@ -0,0 +1,361 @@
+'''
+A local stand-in for the parts of the Gazelle API that REDBetter uses,
+for load testing prefetching, rate limiting and paging through snatches
+without going near the real site:
+
+    python -m benchmarks.gazelle --port 8080 --snatches 20000 --latency 0.2 --throttle-rate 0.05
+
+and, in the config, base_url = http://localhost:8080/ and tracker =
+http://localhost:8080/tracker/. It answers the ajax.php actions index,
+user_torrents, torrentgroup, torrent, better and download, and
+torrents.php?action=download, with made up but consistent releases.
+
+With --record URL it forwards every request to the real site instead
+and saves the responses as fixtures in --fixtures, which --replay then
+serves. The authkey and passkey are scrubbed from recorded index
+responses, but downloaded .torrent files still hold your passkey.
+'''
+import argparse
+import base64
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qsl, urlparse
+
+import requests
+
+from red_better import torrent
+from red_better.cache import atomic_write
+
+authkey = 'a' * 32
+passkey = 'p' * 32
+userid = 1
+
+# Request parameters that differ between sessions and so are left out of
+# fixture keys.
+session_params = {'auth', 'authkey', 'torrent_pass'}
+
+artists = ['Synthetic', 'The Generators', 'Noise Floor', 'Pink & Sine', 'Dither']
+media = ['CD', 'WEB', 'Vinyl']
+
+
+class SyntheticSite:
+    '''
+    Made up snatches, torrent groups and torrents. Torrent n is a FLAC in
+    group n; whether the group already has transcodes, and the details of
+    the release, are drawn from a random generator seeded with n.
+    '''
+
+    def __init__(self, snatches, seed=0):
+        self.snatches = snatches
+        self.seed = seed
+
+    def _random(self, groupid):
+        return random.Random(self.seed * 1000003 + groupid)
+
+    def group(self, groupid):
+        rng = self._random(groupid)
+        year = rng.randint(1960, 2020)
+        name = f'Album {groupid}'
+        tracks = rng.randint(4, 20)
+        release = {
+            'media': rng.choice(media),
+            'remasterYear': year,
+            'remasterTitle': rng.choice(['', '', 'Remastered', 'Deluxe Edition']),
+            'remasterRecordLabel': 'Synthetic Records',
+            'remasterCatalogueNumber': f'SYN{groupid:06d}',
+            'reported': False,
+        }
+        flac = dict(release, id=groupid, format='FLAC', encoding=rng.choice(['Lossless', '24bit Lossless']),
+                    filePath=f'Artist - {name} ({year}) [FLAC]',
+                    fileList='|||'.join(f'{n:02d} - Track {n}.flac{{{{{{{rng.randint(10, 60) << 20}}}}}}}'
+                                        for n in range(1, tracks + 1)))
+        torrents = [flac]
+        for offset, (format, encoding) in enumerate([('MP3', 'V0 (VBR)'), ('MP3', '320')], 1):
+            if rng.random() < 0.3:
+                torrents.append(dict(release, id=self.snatches + groupid * 2 + offset, format=format,
+                                     encoding=encoding, filePath='', fileList=''))
+        return {
+            'group': {
+                'id': groupid,
+                'name': name,
+                'year': year,
+                'musicInfo': {'artists': [{'id': groupid % len(artists) + 1,
+                                           'name': artists[groupid % len(artists)]}]},
+            },
+            'torrents': torrents,
+        }
+
+    def torrent_group(self, torrentid):
+        groupid = torrentid if torrentid <= self.snatches else (torrentid - self.snatches - 1) // 2
+        return self.group(groupid)
+
+    def ajax(self, action, params):
+        '''Returns the response to an ajax.php action, or None if it fails.'''
+        if action == 'index':
+            return {'username': 'benchmark', 'id': userid, 'authkey': authkey, 'passkey': passkey}
+        if action == 'user_torrents':
+            offset = int(params.get('offset', 0))
+            limit = int(params.get('limit', 500))
+            ids = range(self.snatches - offset, max(self.snatches - offset - limit, 0), -1)
+            return {'snatched': [{'groupId': str(torrentid), 'torrentId': str(torrentid),
+                                  'name': f'Album {torrentid}'} for torrentid in ids]}
+        if action == 'torrentgroup':
+            groupid = int(params['id'])
+            if not 0 < groupid <= self.snatches:
+                return None
+            return self.group(groupid)
+        if action == 'torrent':
+            torrentid = int(params['id'])
+            group = self.torrent_group(torrentid)
+            for group_torrent in group['torrents']:
+                if group_torrent['id'] == torrentid:
+                    return {'group': group['group'], 'torrent': group_torrent}
+            return None
+        if action == 'better':
+            return [{'torrentId': torrentid, 'downloadUrl': f'torrents.php?action=download&id={torrentid}'}
+                    for torrentid in range(1, min(self.snatches, 50) + 1)]
+        return None
+
+    def download(self, torrentid):
+        '''Returns a .torrent of the files of a FLAC torrent.'''
+        flac = self.torrent_group(torrentid)['torrents'][0]
+        files = [(item.split('{{{')[0], int(item.split('{{{')[1].rstrip('}'))) for item in flac['fileList'].split('|||')]
+        piece_length = 18
+        pieces = -(-sum(size for _, size in files) // (1 << piece_length))
+        rng = self._random(torrentid)
+        return torrent.metainfo(flac['filePath'], files, rng.getrandbits(160 * pieces).to_bytes(20 * pieces, 'big'),
+                                torrent.announce_url('http://localhost/tracker/', passkey), piece_length)
+
+
+class Fixtures:
+    '''Recorded responses, one file per request path and parameters.'''
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, path, params) -> Path:
+        key = json.dumps([path, sorted((k, v) for k, v in params.items() if k not in session_params)])
+        return self.root / (hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, path, params):
+        try:
+            with open(str(self._path(path, params)), 'r') as fixture:
+                entry = json.load(fixture)
+        except (OSError, ValueError):
+            return None
+        return entry['status'], entry['content_type'], base64.b64decode(entry['body'])
+
+    def put(self, path, params, status, content_type, body):
+        atomic_write(self._path(path, params), json.dumps({
+            'path': path,
+            'params': {k: v for k, v in params.items() if k not in session_params},
+            'status': status,
+            'content_type': content_type,
+            'body': base64.b64encode(body).decode('ascii'),
+        }))
+
+
+def scrub(params, content_type, body):
+    '''Replaces the authkey and passkey in a recorded index response.'''
+    if params.get('action') != 'index' or 'json' not in content_type:
+        return body
+    parsed = json.loads(body)
+    if isinstance(parsed.get('response'), dict):
+        parsed['response'].update({'authkey': authkey, 'passkey': passkey})
+    return json.dumps(parsed).encode('utf-8')
+
+
+class Faults:
+    '''
+    Injected latency, server errors and 429s, plus a real rate limit of
+    rate_limit requests per rate_window seconds (0 for none).
+    '''
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=2,
+                 rate_limit=0, rate_window=10.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.random = random.Random(seed)
+        self.requests = deque()
+        self.lock = threading.Lock()
+
+    def delay(self):
+        with self.lock:
+            jitter = self.random.uniform(0, self.jitter)
+        time.sleep(self.latency + jitter)
+
+    def fault(self):
+        '''Returns the status to answer with instead of the response, if any.'''
+        with self.lock:
+            now = time.monotonic()
+            while self.requests and now - self.requests[0] > self.rate_window:
+                self.requests.popleft()
+            self.requests.append(now)
+            if self.rate_limit and len(self.requests) > self.rate_limit:
+                return 429
+            roll = self.random.random()
+        if roll < self.throttle_rate:
+            return 429
+        if roll < self.throttle_rate + self.error_rate:
+            return 502
+        return None
+
+
+class Handler(BaseHTTPRequestHandler):
+    # Set on the server: site, faults, fixtures, upstream, stats.
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.handle_request(dict(parse_qsl(self.rfile.read(length).decode('utf-8'))))
+
+    def handle_request(self, form=None):
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        label = params.get('action', url.path)
+        self.server.faults.delay()
+        fault = self.server.faults.fault()
+        if fault is not None:
+            self.server.count(label, fault)
+            headers = {'Retry-After': str(self.server.faults.retry_after)} if fault == 429 else None
+            self.send(fault, 'text/plain', b'Injected failure', headers)
+            return
+
+        if self.server.upstream:
+            status, content_type, body = self.record(url, params, form)
+        elif self.server.fixtures:
+            fixture = self.server.fixtures.get(url.path, params)
+            if fixture is None:
+                status, content_type, body = 404, 'application/json', json.dumps(
+                    {'status': 'failure', 'error': 'no fixture for this request'}).encode('utf-8')
+            else:
+                status, content_type, body = fixture
+        else:
+            status, content_type, body = self.synthetic(url, params)
+        self.server.count(label, status)
+        self.send(status, content_type, body)
+
+    def record(self, url, params, form):
+        upstream = self.server.upstream.rstrip('/') + url.path
+        headers = {name: self.headers[name] for name in ['Authorization', 'Cookie', 'User-Agent']
+                   if self.headers.get(name)}
+        if form is None:
+            r = requests.get(upstream, params=params, headers=headers, allow_redirects=False)
+        else:
+            r = requests.post(upstream, params=params, data=form, headers=headers, allow_redirects=False)
+        content_type = r.headers.get('Content-Type', 'application/octet-stream')
+        body = scrub(params, content_type, r.content)
+        if r.status_code == 200 and self.server.fixtures:
+            self.server.fixtures.put(url.path, params, r.status_code, content_type, body)
+        return r.status_code, content_type, body
+
+    def synthetic(self, url, params):
+        site = self.server.site
+        if url.path == '/ajax.php':
+            action = params.get('action')
+            if action == 'download':
+                return 200, 'application/x-bittorrent', site.download(int(params['id']))
+            response = site.ajax(action, params)
+            body = {'status': 'failure', 'error': 'bad parameters'} if response is None else \
+                {'status': 'success', 'response': response}
+            return 200, 'application/json', json.dumps(body).encode('utf-8')
+        if url.path == '/torrents.php' and params.get('action') == 'download':
+            return 200, 'application/x-bittorrent', site.download(int(params['id']))
+        if url.path in ('/', '/index.php', '/login.php', '/logout.php'):
+            return 200, 'text/html', b'<html></html>'
+        return 404, 'text/plain', b'Not found'
+
+
+class GazelleServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, site=None, faults=None, fixtures=None, upstream=None, verbose=False):
+        super().__init__(address, Handler)
+        self.site = site or SyntheticSite(1000)
+        self.faults = faults or Faults()
+        self.fixtures = fixtures
+        self.upstream = upstream
+        self.verbose = verbose
+        self.stats = Counter()
+        self.stats_lock = threading.Lock()
+
+    def count(self, label, status):
+        with self.stats_lock:
+            self.stats[(label, status)] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.gazelle',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--snatches', type=int, default=1000, help='how many snatched torrents to make up')
+    parser.add_argument('--seed', type=int, default=0, help='the seed of the made up releases and faults')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait before every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to how many more seconds to wait at random')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='the fraction of requests answered with 502')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='the fraction of requests answered with 429')
+    parser.add_argument('--retry-after', type=int, default=2, help='the Retry-After of a 429, in seconds')
+    parser.add_argument('--rate-limit', type=int, default=0,
+                        help='answer with 429 past this many requests per --rate-window (0 for no limit)')
+    parser.add_argument('--rate-window', type=float, default=10.0)
+    parser.add_argument('--fixtures', help='the directory recorded responses are kept in')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--record', metavar='URL', help='forward requests to URL and record its responses')
+    mode.add_argument('--replay', action='store_true', help='serve the responses recorded in --fixtures')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log every request')
+    args = parser.parse_args()
+
+    if (args.record or args.replay) and not args.fixtures:
+        parser.error('--record and --replay need --fixtures')
+
+    server = GazelleServer(
+        (args.host, args.port),
+        SyntheticSite(args.snatches, args.seed),
+        Faults(args.latency, args.jitter, args.error_rate, args.throttle_rate, args.retry_after,
+               args.rate_limit, args.rate_window, args.seed),
+        Fixtures(args.fixtures) if args.fixtures and (args.record or args.replay) else None,
+        args.record,
+        args.verbose,
+    )
+    print(f'Serving on http://{args.host}:{args.port}/ (Ctrl-C to stop)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    for (label, status), count in sorted(server.stats.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+        print(f'{label:<20} {status}  {count}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+'''
+Times the hot paths of REDBetter on synthetic releases, each on its own
+and end to end over a range of --threads, and writes the timings as
+JSON so that runs on different commits can be compared with
+benchmarks.compare.
+
+    python -m benchmarks.run --threads 1 2 4 --output before.json
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from multiprocessing import cpu_count
+from pathlib import Path
+
+from benchmarks import synthetic
+from red_better import tagging, torrent, transcode
+from red_better.cache import Cache
+from red_better.dataindex import DataIndex
+from red_better.manifest import ReleaseManifest
+
+announce = 'https://tracker.invalid/benchmark/announce'
+piece_length = 18
+cache_entries = 1000
+
+
+def commit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, cwd=str(Path(__file__).parent), check=True)
+        return result.stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+class Bench:
+    '''Runs benchmarks and collects their timings.'''
+
+    def __init__(self, repeat, scratch):
+        self.repeat = repeat
+        self.scratch = Path(scratch)
+        self.results = []
+
+    def time(self, name, release, fn, setup=None, threads=None):
+        '''
+        Times fn(state) repeat times, where state is what setup(scratch)
+        returns for a fresh scratch directory, and records the timings.
+        '''
+        seconds = []
+        for _ in range(self.repeat):
+            scratch = Path(tempfile.mkdtemp(dir=str(self.scratch)))
+            try:
+                state = setup(scratch) if setup else scratch
+                start = time.perf_counter()
+                fn(state)
+                seconds.append(time.perf_counter() - start)
+            finally:
+                shutil.rmtree(str(scratch), ignore_errors=True)
+        result = {
+            'name': name,
+            'release': release,
+            'threads': threads,
+            'seconds': seconds,
+            'best': min(seconds),
+            'mean': sum(seconds) / len(seconds),
+        }
+        self.results.append(result)
+        label = name + (f' -j{threads}' if threads else '') + (f' [{release}]' if release else '')
+        print(f'{label:<60} best {result["best"]:8.3f}s  mean {result["mean"]:8.3f}s')
+        return result
+
+
+def bench_release(bench, release_dir, formats, threads_list):
+    release = release_dir.name
+    flac_files = [str(path) for path in sorted(release_dir.glob('*.flac'))]
+
+    bench.time('manifest+probe', release,
+               lambda _: transcode.probe_release(str(release_dir), ReleaseManifest(str(release_dir))))
+
+    def tag_targets(scratch):
+        targets = []
+        for i, flac_file in enumerate(flac_files):
+            target = scratch / f'{i:02d}.mp3'
+            target.write_bytes(b'\0' * 4096)
+            targets.append((flac_file, str(target)))
+        return targets
+
+    bench.time('copy_tags', release,
+               lambda targets: [tagging.copy_tags(flac_file, target) for flac_file, target in targets],
+               tag_targets)
+
+    bench.time('make_torrent', release, lambda _: torrent.make_torrent(str(release_dir), announce, piece_length))
+
+    for threads in threads_list:
+        bench.time('transcode_release', release,
+                   lambda scratch: transcode.transcode_release_formats(
+                       str(release_dir), str(scratch), 'Benchmark (', formats, threads),
+                   threads=threads)
+
+    for threads in threads_list:
+        def end_to_end(scratch):
+            manifest = ReleaseManifest(str(release_dir))
+            probe = transcode.probe_release(str(release_dir), manifest)
+            with transcode.TranscodePool(threads) as pool:
+                job = pool.submit(str(release_dir), str(scratch), 'Benchmark (', formats, probe, manifest,
+                                  announce, piece_length)
+                if not job:
+                    return
+                transcode_dirs = job.wait()
+                for output_format, transcode_dir in transcode_dirs.items():
+                    transcode.make_torrent(transcode_dir, str(scratch / 'torrents'), 'https://tracker.invalid/',
+                                           'benchmark', piece_length, stream=job.streams.get(output_format))
+
+        bench.time('end_to_end', release, end_to_end, threads=threads)
+
+
+def drop_caches() -> bool:
+    '''Drops the kernel's page, dentry and inode caches, which needs root. Returns whether it could.'''
+    try:
+        os.sync()
+        with open('/proc/sys/vm/drop_caches', 'w') as drop:
+            drop.write('3\n')
+        return True
+    except OSError:
+        return False
+
+
+def bench_locate(bench, releases_root, release_dirs):
+    def walk(_):
+        flac_files = transcode.locate(str(releases_root), transcode.ext_matcher('.flac'))
+        found = {os.path.dirname(path) for path in flac_files}
+        if not {str(release_dir.resolve()) for release_dir in release_dirs} <= found:
+            raise RuntimeError(f'locate missed releases under {releases_root}')
+
+    def cold(scratch):
+        drop_caches()
+        return scratch
+
+    def warm(scratch):
+        walk(scratch)
+        return scratch
+
+    if drop_caches():
+        bench.time('locate (cold)', None, walk, cold)
+    else:
+        print('Skipping locate (cold): dropping the kernel caches needs root.')
+    bench.time('locate (warm)', None, walk, warm)
+
+    # Finding a moved release by its files in the DataIndex instead.
+    files = {release_dir: [(path.name, path.stat().st_size) for path in release_dir.iterdir()]
+             for release_dir in release_dirs}
+
+    def find_all(index):
+        for release_dir, release_files in files.items():
+            if index.find('Moved ' + release_dir.name, release_files) != str(release_dir):
+                raise RuntimeError(f'{release_dir} was not found')
+
+    def cold_index(scratch):
+        return DataIndex(scratch / 'dataindex', [releases_root])
+
+    def warm_index(scratch):
+        DataIndex(scratch / 'dataindex', [releases_root]).refresh()
+        return DataIndex(scratch / 'dataindex', [releases_root])
+
+    bench.time('DataIndex.find (cold index)', None, find_all, cold_index)
+    bench.time('DataIndex.find (warm index)', None, find_all, warm_index)
+
+
+def bench_cache(bench):
+    def add(scratch):
+        cache = Cache()
+        for torrent_id in range(cache_entries):
+            cache.add(torrent_id, 'uploaded', scratch / 'cache')
+
+    bench.time(f'Cache.add x{cache_entries}', None, add)
+
+
+def main():
+    default_threads = sorted({1, 2, 4, cpu_count()})
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.run',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--releases', default=Path('./.redactedbetter/benchmarks'),
+                        help='the directory the synthetic releases are made in (and reused from)')
+    parser.add_argument('--source-formats', nargs='+', choices=list(synthetic.source_formats),
+                        default=list(synthetic.source_formats))
+    parser.add_argument('--layouts', nargs='+', choices=list(synthetic.layouts), default=list(synthetic.layouts))
+    parser.add_argument('--formats', nargs='+', choices=list(transcode.encoders), default=['V0', '320'],
+                        help='the formats to transcode to')
+    parser.add_argument('-j', '--threads', nargs='+', type=int, default=default_threads,
+                        help='the thread counts to time the transcodes with')
+    parser.add_argument('--repeat', type=int, default=3, help='how many times to time each benchmark')
+    parser.add_argument('--output', help='where to write the results (default: benchmarks/results/<commit>.json)')
+    args = parser.parse_args()
+
+    releases_root = Path(args.releases).expanduser()
+    releases_root.mkdir(parents=True, exist_ok=True)
+    release_dirs = []
+    for source_format in args.source_formats:
+        for layout in args.layouts:
+            # Artwork and a log with the first layout only, so that both
+            # kinds of release are timed without doubling the run.
+            extras = layout == args.layouts[0]
+            print(f'Making {synthetic.release_name(source_format, layout, extras)}...')
+            release_dirs.append(synthetic.make_release(releases_root, source_format, layout, extras))
+
+    with tempfile.TemporaryDirectory() as scratch:
+        bench = Bench(args.repeat, scratch)
+        bench_cache(bench)
+        bench_locate(bench, releases_root, release_dirs)
+        for release_dir in release_dirs:
+            bench_release(bench, release_dir, args.formats, args.threads)
+
+    revision = commit()
+    output = Path(args.output) if args.output else Path(__file__).parent / 'results' / f'{revision}.json'
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(str(output), 'w') as output_file:
+        json.dump({
+            'commit': revision,
+            'time': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'repeat': args.repeat,
+            'formats': args.formats,
+            'results': bench.results,
+        }, output_file, indent=2)
+    print(f'Wrote {output}')
+
+
+if __name__ == '__main__':
+    main()
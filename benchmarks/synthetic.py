@@ -0,0 +1,85 @@
+'''
+Reproducible synthetic FLAC releases to benchmark against.
+
+Audio is made by SoX with its default random numbers (-R), so the same
+parameters always give byte-identical files: pink noise on one channel
+and a tone on the other, which compresses about as badly as music.
+'''
+import os
+import random
+import subprocess
+from collections import namedtuple
+from pathlib import Path
+
+import mutagen.flac
+
+Format = namedtuple('Format', ['bits', 'rate'])
+Layout = namedtuple('Layout', ['tracks', 'seconds'])
+
+source_formats = {
+    '16-44': Format(16, 44100),
+    '24-96': Format(24, 96000),
+    '24-192': Format(24, 192000),
+}
+
+layouts = {
+    'many-short': Layout(24, 15),
+    'few-long': Layout(3, 120),
+}
+
+artwork_bytes = 2 << 20
+log_lines = 400
+
+
+def release_name(source_format, layout, extras):
+    return f'Synthetic - {layout} [{source_format}]' + (' (extras)' if extras else '')
+
+
+def make_track(path, source_format, seconds, number):
+    frequency = 110 * (number + 1)
+    subprocess.run(['sox', '-R', '-n', '-b', str(source_format.bits), '-r', str(source_format.rate), str(path),
+                    'synth', str(seconds), 'pinknoise', 'sine', str(frequency), 'gain', '-3'],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+
+
+def tag_track(path, title, number, tracks):
+    info = mutagen.flac.FLAC(str(path))
+    info['artist'] = 'Synthetic'
+    info['album'] = title
+    info['title'] = f'Track {number}'
+    info['tracknumber'] = str(number)
+    info['totaltracks'] = str(tracks)
+    info['date'] = '2020'
+    info.save()
+
+
+def make_extras(release_dir, seed):
+    rng = random.Random(seed)
+    (release_dir / 'cover.jpg').write_bytes(rng.getrandbits(8 * artwork_bytes).to_bytes(artwork_bytes, 'little'))
+    with open(str(release_dir / 'Synthetic.log'), 'w') as log:
+        for line in range(log_lines):
+            log.write(f'Track {line % 24 + 1:2d}  Copy CRC {rng.getrandbits(32):08X}  Copy OK\n')
+
+
+def make_release(root, source_format, layout, extras=False) -> Path:
+    '''
+    Makes the release with the given source_format and layout (keys of
+    source_formats and layouts) in root, with artwork and a rip log if
+    extras is set, and returns its directory. A release that has already
+    been made is reused.
+    '''
+    name = release_name(source_format, layout, extras)
+    release_dir = Path(root) / name
+    if release_dir.exists():
+        return release_dir
+    partial_dir = Path(root) / ('.' + name)
+    partial_dir.mkdir(parents=True, exist_ok=True)
+    tracks, seconds = layouts[layout]
+    for number in range(1, tracks + 1):
+        path = partial_dir / f'{number:02d} - Track {number}.flac'
+        make_track(path, source_formats[source_format], seconds, number)
+        tag_track(path, name, number, tracks)
+    if extras:
+        make_extras(partial_dir, name)
+    os.rename(str(partial_dir), str(release_dir))
+    return release_dir
@@ -0,0 +1,259 @@
+'''
+An asyncio counterpart of RedactedAPI, for code that needs many lookups
+at once (e.g. torrentgroup for every snatch, or torrent for every row of
+better.php).
+
+Every request reserves its place with the shared RateLimiter before it
+is sent and then sleeps until its turn, so any number of requests can
+be in flight and they go out spaced exactly at the rate limit; the
+latency of each overlaps the waits of those behind it instead of adding
+to them. Connections are pooled by a single aiohttp session.
+
+aiohttp is optional; without it, available() is False.
+'''
+import asyncio
+import json
+from collections import deque
+from pathlib import Path
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from red_better.metrics import Metrics
+from red_better.ratelimit import RateLimiter
+from red_better.redactedapi import (LoginException, RequestException, default_base_url, default_tracker,
+                                    headers, retry_after)
+
+default_connections = 8
+
+
+def available() -> bool:
+    return aiohttp is not None
+
+
+class AsyncRedactedAPI:
+    '''
+    Logs in with an API key or the cookies of a logged in session when
+    entered as an async context manager:
+
+        async with AsyncRedactedAPI(page_size, api_key=api_key) as api:
+            groups = await asyncio.gather(*(api.request('torrentgroup', id=groupid) for groupid in groupids))
+    '''
+
+    def __init__(
+            self,
+            page_size,
+            api_key=None,
+            cookies=None,
+            response_cache=None,
+            rate_limiter=None,
+            base_url=default_base_url,
+            tracker=default_tracker,
+            metrics=None,
+            max_connections=default_connections,
+    ):
+        if aiohttp is None:
+            raise RuntimeError('aiohttp is not installed')
+        self.page_size = page_size
+        self.api_key = api_key
+        self.cookies = cookies
+        self.authkey = None
+        self.passkey = None
+        self.userid = None
+        self.base_url = base_url if base_url.endswith('/') else base_url + '/'
+        self.tracker = tracker
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.max_retries = 5
+        self.backoff_base = 5.0 # seconds, doubled on every retry
+        self.response_cache = response_cache
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.max_connections = max_connections
+        self.session = None
+
+    @classmethod
+    def like(cls, api, **kwargs):
+        '''
+        Returns a client that shares the login, rate limiter, response
+        cache and metrics of a logged in RedactedAPI.
+        '''
+        client = cls(
+            api.page_size,
+            api_key=api.api_key if api.api_key_authenticated else None,
+            cookies=None if api.api_key_authenticated else api.session.cookies.get_dict(),
+            response_cache=api.response_cache,
+            rate_limiter=api.rate_limiter,
+            base_url=api.base_url,
+            tracker=api.tracker,
+            metrics=api.metrics,
+            **kwargs
+        )
+        client.authkey = api.authkey
+        client.passkey = api.passkey
+        client.userid = api.userid
+        return client
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def open(self):
+        session_headers = dict(headers)
+        if self.api_key:
+            session_headers['Authorization'] = self.api_key
+        elif not self.cookies:
+            raise LoginException('Either an API key or session cookies are needed')
+        self.session = aiohttp.ClientSession(
+            headers=session_headers,
+            cookies=self.cookies,
+            connector=aiohttp.TCPConnector(limit=self.max_connections),
+        )
+        if self.userid is not None:
+            return
+        try:
+            accountinfo = await self.request('index')
+            if accountinfo is None:
+                raise LoginException
+        except BaseException:
+            await self.close()
+            raise
+        self.authkey = accountinfo['authkey']
+        self.passkey = accountinfo['passkey']
+        self.userid = accountinfo['id']
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _get(self, url, params, tokens=1):
+        '''
+        GETs url once the shared rate limit allows it, backing off and
+        retrying when the site answers with 429 or a server error.
+        Returns the status, headers and body of the response.
+        '''
+        # aiohttp only takes strings as query values.
+        params = {key: str(value) for key, value in params.items()}
+        action = params.get('action')
+        for attempt in range(self.max_retries + 1):
+            waited = await self.rate_limiter.acquire_async(tokens)
+            if waited > 0:
+                self.metrics.record('api_wait', waited, action=action)
+            with self.metrics.span('api_request', action=action) as span:
+                async with self.session.get(url, params=params, allow_redirects=False) as r:
+                    body = await r.read()
+                    span['status'] = r.status
+                    span['bytes_read'] = len(body)
+                    if r.status != 429 and r.status < 500:
+                        return r.status, r.headers, body
+                    delay = retry_after(r) or self.backoff_base * 2 ** attempt
+            print(f'HTTP {r.status} from {url}, backing off for {delay:.0f}s')
+            self.rate_limiter.backoff(delay)
+        return r.status, r.headers, body
+
+    async def request(self, action, passthrough=False, refresh=False, **kwargs):
+        '''
+        Makes an AJAX request at a given action page. Fresh responses from
+        the response cache are used instead, unless refresh is set.
+        '''
+        use_cache = self.response_cache is not None and not passthrough
+        if use_cache and not refresh:
+            cached = self.response_cache.get(action, kwargs)
+            if cached is not None:
+                return cached
+
+        params = {'action': action}
+        if not self.api_key and self.authkey:
+            params['auth'] = self.authkey
+        params.update(kwargs)
+        _, _, content = await self._get(self.base_url + 'ajax.php', params)
+        if passthrough:
+            return content
+        try:
+            parsed = json.loads(content)
+            if parsed['status'] != 'success':
+                return None
+        except ValueError as e:
+            raise RequestException(e)
+        if use_cache:
+            self.response_cache.put(action, kwargs, parsed['response'])
+        return parsed['response']
+
+    def invalidate(self, action, **kwargs):
+        '''Drops the cached response to a request, if there is one.'''
+        if self.response_cache is not None:
+            self.response_cache.invalidate(action, kwargs)
+
+    async def save_torrent_file(self, torrent_id: int, file_path: Path):
+        torrent_file = await self.request('download', passthrough=True, id=torrent_id)
+        with open(str(file_path), 'wb') as file:
+            file.write(torrent_file)
+
+    async def snatched_page(self, page):
+        '''Returns (groupid, torrentid) for one page of snatched torrents, newest first.'''
+        response = await self.request(
+            'user_torrents',
+            id=self.userid,
+            type='snatched',
+            limit=self.page_size,
+            offset=page * self.page_size
+        )
+        return [(int(entry['groupId']), int(entry['torrentId'])) for entry in response['snatched']]
+
+    async def snatched(self, pages_ahead=4):
+        '''
+        Yields (groupid, torrentid) for every snatched torrent, keeping
+        up to pages_ahead pages in flight until one comes back short.
+        '''
+        pending = deque()
+        next_page = 0
+        try:
+            while True:
+                while len(pending) < pages_ahead:
+                    pending.append(asyncio.ensure_future(self.snatched_page(next_page)))
+                    next_page += 1
+                page = next_page - len(pending)
+                snatched = await pending.popleft()
+                if snatched:
+                    print(f'Fetched snatched results {page * self.page_size} to '
+                          f'{page * self.page_size + len(snatched) - 1}')
+                for entry in snatched:
+                    yield entry
+                if len(snatched) < self.page_size:
+                    return
+        finally:
+            for request in pending:
+                request.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def permalink(self, torrent):
+        return "%storrents.php?torrentid=%s" % (self.base_url, torrent['id'])
+
+    async def get_better(self, search_type=3, tags=None):
+        if tags is None:
+            tags = []
+        data = await self.request('better', method='transcode', type=search_type, search=' '.join(tags))
+        return [{
+            'permalink': 'torrents.php?id={}'.format(row['torrentId']),
+            'id': row['torrentId'],
+            'torrent': row['downloadUrl'],
+        } for row in data]
+
+    async def get_torrent(self, torrent_id):
+        '''Downloads the torrent at torrent_id using the authkey and passkey'''
+        params = {'action': 'download', 'id': torrent_id}
+        if self.authkey:
+            params['authkey'] = self.authkey
+            params['torrent_pass'] = self.passkey
+        # Downloads are charged double, as they always have been.
+        status, response_headers, content = await self._get(self.base_url + 'torrents.php', params, tokens=2)
+        if status == 200 and 'application/x-bittorrent' in response_headers.get('content-type', ''):
+            return content
+        return None
+
+    async def get_torrent_info(self, id):
+        return (await self.request('torrent', id=id))['torrent']
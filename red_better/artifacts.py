@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+default_max_bytes = 10 << 30
+
+# A FLAC encoder that didn't compute the audio MD5 leaves it zeroed.
+UNSET_MD5 = '0' * 32
+
+
+def file_digest(path) -> str:
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArtifactStore:
+    '''
+    Encoder output kept from earlier transcodes, keyed by the source
+    audio and the commands that encoded it, so that a release retried
+    after its transcode was thrown away (or the same audio in another
+    torrent) is copied rather than encoded again.
+
+    Files may be stored with the tags of the source they were encoded
+    from; they are replaced with the tags of the source being transcoded
+    whenever a file is taken out of the store. Taking a file out
+    refreshes its mtime and trim() removes the least recently
+    used files first.
+
+    Stores are passed to pool workers, so hits and misses counted in a
+    worker have to be added to the parent's store with record().
+    '''
+
+    def __init__(self, root, max_bytes=default_max_bytes):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def key(self, flac_file, info, commands) -> str:
+        '''
+        Returns the key of the transcode of flac_file made by commands,
+        which should name their input and output with placeholders rather
+        than real paths. The audio is identified by the MD5 in its
+        STREAMINFO, so retagging the source doesn't change the key.
+        '''
+        audio = info.md5 if info is not None and info.md5 != UNSET_MD5 else file_digest(flac_file)
+        return hashlib.sha1(json.dumps([audio, commands]).encode('utf-8')).hexdigest()
+
+    def _path(self, key, ext) -> Path:
+        return self.root / key[:2] / (key + ext)
+
+    def fetch(self, key, transcode_file) -> bool:
+        '''Copies the stored transcode to transcode_file, if there is one.'''
+        path = self._path(key, os.path.splitext(transcode_file)[1])
+        try:
+            # A copy rather than a hard link, because tagging rewrites
+            # the file in place.
+            shutil.copyfile(str(path), transcode_file)
+            os.utime(str(path))
+        except FileNotFoundError:
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def put(self, key, transcode_file):
+        '''Stores a freshly encoded transcode under key.'''
+        path = self._path(key, os.path.splitext(transcode_file)[1])
+        path.parent.mkdir(exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=str(path.parent), prefix='.')
+        os.close(fd)
+        try:
+            shutil.copyfile(transcode_file, temp_path)
+            os.replace(temp_path, str(path))
+        except:
+            os.unlink(temp_path)
+            raise
+
+    def record(self, hits, misses):
+        self.hits += hits
+        self.misses += misses
+
+    def trim(self):
+        '''Removes the least recently used files until the store fits in max_bytes.'''
+        files = []
+        with os.scandir(str(self.root)) as subdirs:
+            for subdir in subdirs:
+                if not subdir.is_dir():
+                    continue
+                with os.scandir(subdir.path) as it:
+                    # Dotfiles are stores still being written.
+                    files.extend((entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                                 for entry in it if not entry.name.startswith('.'))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -1,7 +1,63 @@
+import json
+import os
+import tempfile
 from pathlib import Path
 
 import jsonpickle
 
+# Once a journal grows past this many bytes it is folded back into its
+# snapshot, so that replaying it on startup stays cheap.
+COMPACT_BYTES = 1 << 20
+
+
+def journal_path(path: Path) -> Path:
+    return path.with_name(path.name + '.journal')
+
+
+def atomic_write(path: Path, data: str):
+    '''
+    Replaces the contents of path with data. Readers (and a process that
+    is killed halfway through) see either the old or the new contents.
+    '''
+    fd, temp_path = tempfile.mkstemp(dir=str(path.parent), prefix=f'.{path.name}.')
+    try:
+        with os.fdopen(fd, 'w') as temp_file:
+            temp_file.write(data)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, str(path))
+    except:
+        os.unlink(temp_path)
+        raise
+
+
+def append_record(path: Path, record) -> int:
+    '''
+    Appends a single JSON record to the journal at path and returns the
+    size of the journal afterwards.
+    '''
+    with open(str(path), 'a') as journal:
+        journal.write(json.dumps(record) + '\n')
+        journal.flush()
+        os.fsync(journal.fileno())
+        return journal.tell()
+
+
+def read_records(path: Path):
+    '''
+    Yields the records in the journal at path. A record torn by an
+    interrupted write never parses, so it is skipped.
+    '''
+    try:
+        with open(str(path), 'r') as journal:
+            for line in journal:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        return
+
 
 class Cache:
 
@@ -14,15 +70,96 @@ class Cache:
             with open(str(cache_path), 'r') as cache_file:
                 cache = jsonpickle.decode(cache_file.read())
                 cache.ids = {int(key): cache.ids[key] for key in cache.ids}
-                return cache
         except:
-            return Cache()
+            cache = Cache()
+
+        # Statuses added since the last snapshot live in the journal. Fold
+        # them in now so that the journal starts out empty (and free of
+        # any torn record) for this run.
+        journal = journal_path(Path(cache_path))
+        if journal.exists():
+            for record in read_records(journal):
+                cache.ids[int(record['id'])] = record['reason']
+            cache.write(cache_path)
+        return cache
 
     def add(self, torrent_id: str, reason: str, cache_path: Path):
         self.ids[torrent_id] = reason
-        self.write(cache_path)
+        journal_size = append_record(journal_path(Path(cache_path)),
+                                     {'id': torrent_id, 'reason': reason})
+        if journal_size > COMPACT_BYTES:
+            self.write(cache_path)
 
     def write(self, cache_path: Path):
-        with open(str(cache_path), 'w') as cache_file:
-            encoded = jsonpickle.encode(self)
-            cache_file.write(encoded)
+        cache_path = Path(cache_path)
+        atomic_write(cache_path, jsonpickle.encode(self))
+        journal = journal_path(cache_path)
+        if journal.exists():
+            journal.unlink()
+
+
+class JournaledStore:
+    '''
+    A dict persisted as a JSON snapshot plus a journal of the changes
+    made since, in the same way as Cache. Keys are converted back with
+    key_type when loading, since JSON object keys are always strings.
+    '''
+
+    def __init__(self, path: Path, key_type=str):
+        self.path = Path(path)
+        self.key_type = key_type
+        self.data = {}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.load()
+
+    def load(self):
+        try:
+            with open(str(self.path), 'r') as snapshot:
+                self.data = {self.key_type(k): v for k, v in json.load(snapshot).items()}
+        except (OSError, ValueError):
+            self.data = {}
+        journal = journal_path(self.path)
+        if journal.exists():
+            for record in read_records(journal):
+                key = self.key_type(record['key'])
+                if 'value' in record:
+                    self.data[key] = record['value']
+                else:
+                    self.data.pop(key, None)
+            self.compact()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def values(self):
+        return self.data.values()
+
+    def items(self):
+        return self.data.items()
+
+    def set(self, key, value):
+        self.data[key] = value
+        self._append({'key': key, 'value': value})
+
+    def delete(self, key):
+        if self.data.pop(key, None) is not None:
+            self._append({'key': key})
+
+    def _append(self, record):
+        if append_record(journal_path(self.path), record) > COMPACT_BYTES:
+            self.compact()
+
+    def compact(self):
+        atomic_write(self.path, json.dumps(self.data))
+        journal = journal_path(self.path)
+        if journal.exists():
+            journal.unlink()
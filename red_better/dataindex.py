@@ -0,0 +1,115 @@
+import os
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from red_better.cache import JournaledStore
+
+
+class DataIndex(JournaledStore):
+    '''
+    Every directory under a set of roots, keyed by path, with the mtime
+    it had when it was listed, the size of each file in it and the names
+    of its subdirectories. A directory whose mtime hasn't changed isn't
+    listed again, so refreshing the index costs a stat per directory.
+
+    Releases are looked up by directory name, or by the size and name of
+    their largest file, and then checked against all of their files.
+    '''
+
+    def __init__(self, path: Path, roots: List[Path]):
+        super().__init__(path)
+        self.roots = [os.path.abspath(str(root)) for root in roots]
+        self.by_name = None
+        self.by_file = None
+
+    def refresh(self):
+        '''Brings the index up to date with the directories on disk.'''
+        visited = set()
+        changed = 0
+        stack = list(self.roots)
+        while stack:
+            path = stack.pop()
+            if path in visited:
+                continue
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            record = self.data.get(path)
+            if record is None or record['mtime'] != mtime:
+                record = list_directory(path, mtime)
+                if record is None:
+                    continue
+                # Written out once at the end rather than journaled, since
+                # the first refresh lists every directory.
+                self.data[path] = record
+                changed += 1
+            visited.add(path)
+            stack.extend(os.path.join(path, name) for name in record['dirs'])
+
+        for path in [path for path in self.data if path not in visited]:
+            del self.data[path]
+            changed += 1
+        if changed:
+            self.compact()
+
+        self.by_name = {}
+        self.by_file = {}
+        for path, record in self.data.items():
+            self.by_name.setdefault(os.path.basename(path), []).append(path)
+            for name, size in record['files'].items():
+                self.by_file.setdefault((name, size), []).append(path)
+
+    def matches(self, root: str, files: List[Tuple[str, int]]) -> bool:
+        '''Returns True if every (relpath, size) in files is under root.'''
+        for relpath, size in files:
+            head, name = os.path.split(os.path.normpath(relpath))
+            record = self.data.get(os.path.join(root, head) if head else root)
+            if record is None or record['files'].get(name) != size:
+                return False
+        return True
+
+    def find(self, dirname: Optional[str], files: List[Tuple[str, int]]) -> Optional[str]:
+        '''
+        Returns the directory holding a release's files, given as (relpath,
+        size) pairs, preferring one named dirname. Returns None if no
+        directory under the roots holds all of them.
+        '''
+        if self.by_name is None:
+            self.refresh()
+
+        if dirname:
+            for path in self.by_name.get(os.path.basename(os.path.normpath(dirname)), []):
+                if self.matches(path, files):
+                    return path
+        if not files:
+            return None
+
+        relpath, size = max(files, key=lambda file: file[1])
+        head, name = os.path.split(os.path.normpath(relpath))
+        for path in self.by_file.get((name, size), []):
+            if head:
+                if not path.endswith(os.sep + head):
+                    continue
+                path = path[:-len(head) - 1]
+            if self.matches(path, files):
+                return path
+        return None
+
+
+def list_directory(path: str, mtime: int) -> Optional[dict]:
+    files = {}
+    dirs = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.name)
+                    elif entry.is_file():
+                        files[entry.name] = entry.stat().st_size
+                except OSError:
+                    continue
+    except OSError:
+        return None
+    return {'mtime': mtime, 'files': files, 'dirs': dirs}
@@ -1,16 +1,180 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import subprocess
+from typing import List, Optional
+import hashlib
+import os
+import threading
 
+from red_better import torrent
+from red_better.cache import JournaledStore
 
-def run_hashcheck(torrent_file_path: Path, data_dir: Path):
-    command = f'imdl -t torrent verify --input \"{torrent_file_path}\" --content \"{data_dir}\"'
+# Files are read from this many threads at once. Keep it low for
+# spinning disks, where more readers only add seeking.
+default_threads = 4
+
+TorrentFile = namedtuple('TorrentFile', ['relpath', 'size'])
+HashcheckFailure = namedtuple('HashcheckFailure', ['relpaths', 'reason'])
+
+
+class TorrentContents:
+    '''The files and piece hashes listed in a .torrent.'''
+
+    def __init__(self, torrent_file_path: Path):
+        with open(str(torrent_file_path), 'rb') as torrent_file:
+            metainfo = torrent.bdecode(torrent_file.read())
+        info = metainfo[b'info']
+        self.infohash = hashlib.sha1(torrent.bencode(info)).hexdigest()
+        self.name = info[b'name'].decode('utf-8')
+        self.piece_length = info[b'piece length']
+        pieces = info[b'pieces']
+        self.pieces = [pieces[i:i + 20] for i in range(0, len(pieces), 20)]
+        if b'files' in info:
+            self.files = [TorrentFile(os.path.join(*(part.decode('utf-8') for part in f[b'path'])), f[b'length'])
+                          for f in info[b'files']]
+        else:
+            self.files = [TorrentFile(self.name, info[b'length'])]
+
+    @property
+    def size(self):
+        return sum(f.size for f in self.files)
+
+    def piece_files(self, piece) -> List[str]:
+        '''Returns the files a piece holds part of.'''
+        start = piece * self.piece_length
+        end = start + self.piece_length
+        relpaths = []
+        offset = 0
+        for f in self.files:
+            if f.size and offset < end and start < offset + f.size:
+                relpaths.append(f.relpath)
+            offset += f.size
+        return relpaths
+
+    def file_pieces(self):
+        '''Yields each file with the range of pieces that hold part of it.'''
+        offset = 0
+        for f in self.files:
+            yield f, range(offset // self.piece_length, -(-(offset + f.size) // self.piece_length))
+            offset += f.size
+
+
+class HashcheckCache(JournaledStore):
+    '''
+    The files of each torrent (by infohash) that have passed a hashcheck,
+    with the size, mtime and inode they had at the time. A file that
+    still has all three is not read again.
+    '''
+
+    def trusted(self, infohash, identities) -> set:
+        '''Returns the files whose identity hasn't changed since they passed.'''
+        verified = self.get(infohash, {})
+        return {relpath for relpath, identity in identities.items() if verified.get(relpath) == identity}
+
+    def record(self, infohash, identities):
+        self.set(infohash, identities)
+
+
+def content_path(contents: TorrentContents, data_dir: Path, relpath: str) -> Path:
+    # For a single file torrent, data_dir is either the file itself or
+    # the directory holding it.
+    if len(contents.files) == 1 and data_dir.is_file():
+        return data_dir
+    return data_dir / relpath
+
+
+def check_sizes(contents: TorrentContents, data_dir: Path):
+    '''
+    Returns what is wrong with the sizes of the files in data_dir, and
+    the [size, mtime, inode] identity of each file.
+    '''
+    failures = []
+    identities = {}
+    for f in contents.files:
+        path = content_path(contents, data_dir, f.relpath)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            failures.append(HashcheckFailure([f.relpath], 'missing'))
+            continue
+        if stat.st_size != f.size:
+            failures.append(HashcheckFailure([f.relpath], f'is {stat.st_size} bytes, expected {f.size}'))
+        identities[f.relpath] = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+    return failures, identities
+
+
+def verify(torrent_file_path: Path, data_dir: Path, threads=default_threads,
+           cache: Optional[HashcheckCache] = None) -> List[HashcheckFailure]:
+    '''
+    Verifies the files in data_dir against a .torrent, returning what is
+    wrong with them: an empty list if they are intact. Missing and
+    truncated files are found without reading anything; otherwise pieces
+    are hashed on threads threads until the first one that doesn't match.
+
+    With a cache, only the pieces holding part of a file that has changed
+    since it last passed are hashed.
+    '''
+    contents = TorrentContents(torrent_file_path)
+    failures, identities = check_sizes(contents, data_dir)
+    if failures:
+        return failures
+
+    total = contents.size
+    if len(contents.pieces) != -(-total // contents.piece_length):
+        return [HashcheckFailure([f.relpath for f in contents.files], 'do not match the number of pieces')]
+
+    trusted = cache.trusted(contents.infohash, identities) if cache is not None else set()
+    needed = sorted({piece for f, pieces in contents.file_pieces() if f.relpath not in trusted for piece in pieces})
+    if not needed:
+        return []
+
+    files = [(str(content_path(contents, data_dir, f.relpath)), f.size) for f in contents.files]
+    starts = torrent.file_starts(files)
+    stop = threading.Event()
+
+    def check(pieces):
+        if stop.is_set():
+            return None
+        for first, count in runs(pieces):
+            digests = torrent.hash_pieces(files, starts, contents.piece_length, total, first, count)
+            for piece, digest in enumerate(digests, first):
+                if digest != contents.pieces[piece]:
+                    stop.set()
+                    return piece
+        return None
+
+    with ThreadPoolExecutor(max(threads, 1)) as executor:
+        futures = [executor.submit(check, needed[i:i + torrent.PIECES_PER_TASK])
+                   for i in range(0, len(needed), torrent.PIECES_PER_TASK)]
+        bad_pieces = [future.result() for future in futures]
+    bad_pieces = [piece for piece in bad_pieces if piece is not None]
+    if bad_pieces:
+        piece = min(bad_pieces)
+        return [HashcheckFailure(contents.piece_files(piece), f'piece {piece} does not match')]
+
+    if cache is not None:
+        cache.record(contents.infohash, identities)
+    return []
+
+
+def runs(pieces):
+    '''Yields (first, count) for each run of consecutive piece numbers.'''
+    first = previous = pieces[0]
+    for piece in pieces[1:]:
+        if piece != previous + 1:
+            yield first, previous - first + 1
+            first = piece
+        previous = piece
+    yield first, previous - first + 1
+
+
+def run_hashcheck(torrent_file_path: Path, data_dir: Path, threads=default_threads,
+                  cache: Optional[HashcheckCache] = None) -> bool:
     try:
-        subprocess.check_output(
-            command,
-            stderr=subprocess.STDOUT,
-            shell=True
-        )
-        return True
-    except subprocess.CalledProcessError as e:
-        print(e.output.decode('utf-8'))
-        return False
\ No newline at end of file
+        failures = verify(torrent_file_path, data_dir, threads, cache)
+    except (OSError, ValueError, KeyError) as e:
+        print(f'Could not verify {data_dir}: {e}')
+        return False
+    for failure in failures:
+        print(f'{", ".join(failure.relpaths)}: {failure.reason}')
+    return not failures
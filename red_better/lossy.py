@@ -0,0 +1,147 @@
+'''
+Spotting lossy masters passed off as FLAC, from the lowpass shelf that
+MP3 and AAC encoders leave in the spectrum.
+
+NumPy is optional; without it, available() is False and every release
+is left to a person to judge from its spectrograms.
+'''
+import subprocess
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from red_better.manifest import ReleaseManifest
+from red_better.probe import ReleaseProbe
+
+CLEAN = 'clean'
+LOSSY = 'lossy'
+AMBIGUOUS = 'ambiguous'
+
+# Lowpass frequencies of common lossy encoders: 16 kHz for 128 kbps MP3,
+# 19-20 kHz for V0/320 MP3 and most AAC. Shelves are looked for within
+# cutoff_tolerance of each.
+cutoffs = [16000, 19000, 20000]
+cutoff_tolerance = 500
+cutoff_step = 50
+# Bands either side of a cutoff that are compared, leaving a gap for the
+# slope of the filter.
+band_gap = 300
+band_width = 1200
+
+# A drop across a cutoff of at least lossy_db is a shelf; tracks whose
+# largest drop is under clean_db show no sign of one.
+lossy_db = 30.0
+clean_db = 15.0
+
+fft_size = 4096
+segments = 6
+segment_seconds = 3.0
+# Frames quieter than this (RMS of a full scale signal is ~0.7) say
+# nothing about the spectrum.
+silence_rms = 1e-4
+
+TrackResult = namedtuple('TrackResult', ['cutoff', 'drop'])
+LossyReport = namedtuple('LossyReport', ['verdict', 'score', 'tracks'])
+
+
+def available() -> bool:
+    return numpy is not None
+
+
+def decode_segment(flac_file, start, duration):
+    '''Returns a segment of a FLAC as mono float32 samples.'''
+    command = ['sox', flac_file, '-t', 'f32', '-', 'remix', '-', 'trim', str(start), str(duration)]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    return numpy.frombuffer(result.stdout, dtype=numpy.float32)
+
+
+def average_spectrum(flac_file, info):
+    '''
+    Returns the average magnitude spectrum (in dB) of frames sampled
+    evenly through a track, or None if they are all silent.
+    '''
+    window = numpy.hanning(fft_size).astype(numpy.float32)
+    total = None
+    count = 0
+    for i in range(segments):
+        start = info.length * (i + 1) / (segments + 1)
+        samples = decode_segment(flac_file, start, segment_seconds)
+        frames = samples[:len(samples) // fft_size * fft_size].reshape(-1, fft_size)
+        frames = frames[numpy.sqrt(numpy.mean(frames ** 2, axis=1)) > silence_rms]
+        if len(frames) == 0:
+            continue
+        magnitudes = numpy.abs(numpy.fft.rfft(frames * window, axis=1)).sum(axis=0)
+        total = magnitudes if total is None else total + magnitudes
+        count += len(frames)
+    if total is None:
+        return None
+    return 20 * numpy.log10(total / count + 1e-12)
+
+
+def find_shelf(spectrum, sample_rate) -> TrackResult:
+    '''Returns the cutoff with the largest drop in level across it.'''
+    bin_hz = sample_rate / fft_size
+    nyquist = sample_rate / 2
+    # Band means from prefix sums, for every candidate cutoff at once.
+    sums = numpy.concatenate([[0.0], numpy.cumsum(spectrum)])
+
+    def band_mean(low, high):
+        low_bin = numpy.round(low / bin_hz).astype(int)
+        high_bin = numpy.round(high / bin_hz).astype(int)
+        return (sums[high_bin] - sums[low_bin]) / numpy.maximum(high_bin - low_bin, 1)
+
+    candidates = numpy.concatenate([numpy.arange(c - cutoff_tolerance, c + cutoff_tolerance + 1, cutoff_step)
+                                    for c in cutoffs])
+    candidates = candidates[candidates + band_gap + band_width / 2 < nyquist]
+    if len(candidates) == 0:
+        return TrackResult(None, 0.0)
+    below = band_mean(candidates - band_gap - band_width, candidates - band_gap)
+    above = band_mean(candidates + band_gap, numpy.minimum(candidates + band_gap + band_width, nyquist))
+    # A recording that simply gets quieter towards the top drops about
+    # as much over the same span below the cutoff; a lowpass doesn't.
+    span = 2 * band_gap + band_width
+    lead = band_mean(candidates - span - band_gap - band_width, candidates - span - band_gap) - below
+    drops = (below - above) - numpy.maximum(lead, 0)
+    best = int(numpy.argmax(drops))
+    return TrackResult(int(candidates[best]), float(drops[best]))
+
+
+def analyze_track(flac_file, info) -> Optional[TrackResult]:
+    spectrum = average_spectrum(flac_file, info)
+    if spectrum is None:
+        return None
+    return find_shelf(spectrum, info.sample_rate)
+
+
+def analyze_release(flac_dir, threads, manifest=None, probe=None) -> LossyReport:
+    '''
+    Looks for a lossy shelf in every FLAC of a release. The verdict is
+    LOSSY if at least half of the tracks have one, CLEAN if none show
+    any sign of one, and AMBIGUOUS otherwise; score is the fraction of
+    tracks with a shelf.
+    '''
+    if manifest is None:
+        manifest = ReleaseManifest(flac_dir)
+    if probe is None:
+        probe = ReleaseProbe(manifest.paths('.flac'))
+    entries = manifest.files('.flac')
+    with ThreadPoolExecutor(max(threads, 1)) as executor:
+        results = list(executor.map(lambda entry: analyze_track(entry.path, probe[entry.path]), entries))
+    tracks = {entry.relpath: result for entry, result in zip(entries, results) if result is not None}
+    if not tracks:
+        return LossyReport(AMBIGUOUS, 0.0, tracks)
+
+    shelves = sum(1 for result in tracks.values() if result.drop >= lossy_db)
+    score = shelves / len(tracks)
+    if shelves * 2 >= len(tracks):
+        verdict = LOSSY
+    elif all(result.drop < clean_db for result in tracks.values()):
+        verdict = CLEAN
+    else:
+        verdict = AMBIGUOUS
+    return LossyReport(verdict, score, tracks)
@@ -5,22 +5,34 @@ from typing import List, Optional
 
 import os
 import shutil
+import subprocess
 import sys
 import tempfile
+from contextlib import nullcontext
 from urllib import parse as urlparse
 from multiprocessing import cpu_count
 
-from red_better import transcode, tagging, redactedapi
+from red_better import transcode, tagging, redactedapi, workqueue, torrent, lossy
+from red_better.artifacts import ArtifactStore
 from red_better.cache import Cache
+from red_better.manifest import ReleaseManifest
+from red_better.metrics import Metrics
+from red_better.profiling import Profiler, default_top
+from red_better.prefetch import Prefetcher
+from red_better.workqueue import WorkQueue
 from red_better.spectrograms import make_spectrograms
-from red_better.hashcheck import run_hashcheck
+from red_better import hashcheck
+from red_better.dataindex import DataIndex
+from red_better.hashcheck import HashcheckCache, run_hashcheck
+from red_better.snatched import SnatchedIndex
+from red_better.staging import Staging
 
 
-def create_description(torrent, flac_dir, format, permalink) -> str:
+def create_description(probe, format, permalink) -> str:
     # Create an example command to document the transcode process.
     cmds = transcode.transcode_commands(format,
-                                        transcode.needs_resampling(flac_dir),
-                                        transcode.resample_rate(flac_dir),
+                                        probe.needs_resampling(),
+                                        probe.resample_rate(),
             'input.flac', 'output' + transcode.encoders[format]['ext'])
 
     description = '\n'.join([
@@ -73,6 +85,7 @@ def parse_config(config_path: Path) -> Optional[ConfigParser]:
         config.set('redacted', 'session_cookie', '')
         config.set('redacted', 'api_key', '')
         config.set('redacted', 'data_dir', '')
+        config.set('redacted', 'extra_data_dirs', '')
         config.set('redacted', 'output_dir', '')
         config.set('redacted', 'torrent_dir', '')
         config.set('redacted', 'spectral_dir', '')
@@ -103,22 +116,58 @@ def validate_formats(formats: List[str]) -> None:
                              f'of {allowed_formats}')
 
 
-def validate_spectrograms(flac_dir_str: str, spectral_dir_str: str, threads: int) -> bool:
+def generate_spectrograms(flac_dir_str: str, spectral_dir_str: str, threads: int,
+                          manifest=None, probe=None) -> bool:
     flac_dir = Path(flac_dir_str)
     spectrogram_dir = Path(spectral_dir_str)
     if spectrogram_dir.exists():
         shutil.rmtree(spectrogram_dir)
-    spectrogram_dir.mkdir()
-    if not make_spectrograms(flac_dir, spectrogram_dir, threads):
+    spectrogram_dir.mkdir(parents=True)
+    return make_spectrograms(flac_dir, spectrogram_dir, threads, manifest, probe)
+
+
+def validate_spectrograms(flac_dir_str: str, spectral_dir_str: str, threads: int,
+                          manifest=None, probe=None, metrics=None) -> bool:
+    if metrics is None:
+        metrics = Metrics()
+    with metrics.span('spectrograms', flac_dir=flac_dir_str):
+        generated = generate_spectrograms(flac_dir_str, spectral_dir_str, threads, manifest, probe)
+    if not generated:
         return False
-    print(f'Spectrograms written to {spectrogram_dir}. Are they acceptable?')
-    response = get_input(['y', 'n'])
+    print(f'Spectrograms written to {spectral_dir_str}. Are they acceptable?')
+    with metrics.span('prompt', flac_dir=flac_dir_str):
+        response = get_input(['y', 'n'])
     if response == 'n':
         print(f'Spectrograms rejected. Skipping.')
         return False
     return True
 
 
+def lossy_verdict(run, flac_dir: str) -> Optional[str]:
+    '''
+    Returns the verdict of the automatic lossy check of a release, or
+    None if it isn't being run.
+    '''
+    if not run.args.auto_spectral:
+        return None
+    if not lossy.available():
+        print('NumPy is not installed, so spectrograms have to be checked by hand.')
+        return None
+    print("\nChecking for a lossy source...")
+    try:
+        with run.metrics.span('lossy', flac_dir=flac_dir):
+            report = lossy.analyze_release(flac_dir, run.args.threads, run.manifest(flac_dir),
+                                           run.probe(flac_dir))
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f'Lossy check failed: {e}')
+        return None
+    for relpath, track in sorted(report.tracks.items()):
+        if track.drop >= lossy.lossy_db:
+            print(f' -> {relpath}: lowpass at {track.cutoff / 1000:.1f} kHz ({track.drop:.0f} dB)')
+    print(f'Lossy check: {report.verdict} ({report.score:.0%} of tracks have a lowpass shelf)')
+    return report.verdict
+
+
 def get_input(choices: List[str]) -> str:
     choice_set = set(choices)
     response = ''
@@ -127,6 +176,540 @@ def get_input(choices: List[str]) -> str:
     return response
 
 
+class Run:
+    '''The settings and state shared by every candidate in a run.'''
+
+    def __init__(self, args, api, cache, cache_path, data_dir, output_dir,
+                 torrent_dir, spectral_dir, supported_formats, piece_length, pool, hashchecks=None,
+                 snatched=None, data_index=None, metrics=None, profiler=None):
+        self.args = args
+        self.api = api
+        self.cache = cache
+        self.cache_path = cache_path
+        self.data_dir = data_dir
+        self.output_dir = output_dir
+        self.torrent_dir = torrent_dir
+        self.spectral_dir = spectral_dir
+        self.supported_formats = supported_formats
+        self.piece_length = piece_length
+        self.pool = pool
+        self.hashchecks = hashchecks
+        self.snatched = snatched
+        # Looks for sources that aren't where their torrent says.
+        self.data_index = data_index
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.profiler = profiler
+        self.manifests = {}
+        self.probes = {}
+        # The tags of each FLAC read when its release was checked.
+        self.tags = {}
+
+    @staticmethod
+    def _remember(memo, flac_dir, make):
+        flac_dir = os.path.abspath(flac_dir)
+        if flac_dir not in memo:
+            # Only the releases currently being worked on are needed.
+            if len(memo) >= 64:
+                del memo[next(iter(memo))]
+            memo[flac_dir] = make(flac_dir)
+        return memo[flac_dir]
+
+    def manifest(self, flac_dir):
+        '''
+        Returns the ReleaseManifest of a release, listing its directory
+        only the first time it is asked for.
+        '''
+        return self._remember(self.manifests, flac_dir, ReleaseManifest)
+
+    def probe(self, flac_dir):
+        '''
+        Returns the ReleaseProbe of a release, reading its files only the
+        first time it is asked for.
+        '''
+        return self._remember(self.probes, flac_dir,
+                              lambda d: transcode.probe_release(d, self.manifest(d)))
+
+    def profile(self, name):
+        '''Profiles the body of a with block as the candidate name, with --profile.'''
+        return self.profiler.candidate(name) if self.profiler else nullcontext()
+
+    def finish(self, torrentid, status):
+        self.cache.add(torrentid, status, self.cache_path)
+
+
+def release_entry(api, groupid, group, torrent) -> dict:
+    '''
+    Returns the details of a release that the later stages need, in a
+    form that can be kept in the work queue.
+    '''
+    if len(group['group']['musicInfo']['artists']) > 1:
+        artist = "Various Artists"
+    else:
+        artist = group['group']['musicInfo']['artists'][0]['name']
+
+    year = str(torrent['remasterYear'])
+    if year == "0":
+        year = str(group['group']['year'])
+
+    title = group['group']['name']
+    if len(torrent['remasterTitle']) >= 1:
+        basename = artist + " - " + title + " (" + torrent['remasterTitle'] + ") " + "[" + year + "] (" + torrent['media'] + " - "
+    else:
+        basename = artist + " - " + title + " [" + year + "] (" + torrent['media'] + " - "
+
+    return {
+        'torrentid': torrent['id'],
+        'groupid': groupid,
+        'artist': artist,
+        'title': title,
+        'basename': basename,
+        'edition': f'{year} - {torrent["remasterRecordLabel"]}',
+        'permalink': api.permalink(torrent),
+    }
+
+
+def find_flac_dir(run: Run, group, torrent) -> Optional[str]:
+    '''
+    Returns the directory the source files should be in, or None if the
+    file of a single file torrent is missing.
+    '''
+    if torrent['filePath']:
+        flac_dir = os.path.join(run.data_dir, redactedapi.unescape(torrent['filePath']))
+        if not os.path.exists(flac_dir) and run.data_index is not None:
+            found = run.data_index.find(redactedapi.unescape(torrent['filePath']), redactedapi.file_list(torrent))
+            if found is not None:
+                print(f'Found {flac_dir} at {found}')
+                return found
+        return flac_dir
+
+    flac_file = os.path.join(run.data_dir, redactedapi.unescape(torrent['fileList']).split('{{{')[0])
+    if not Path(flac_file).exists() and run.data_index is not None:
+        files = redactedapi.file_list(torrent)
+        found = run.data_index.find(None, files)
+        if found is not None:
+            print(f'Found {flac_file} at {found}')
+            flac_file = os.path.join(found, files[0][0])
+    if not Path(flac_file).exists():
+        print("Path not found - skipping: %s" % flac_file)
+        return None
+    flac_dir = os.path.join(run.data_dir, "%s (%s) [FLAC]" % (
+        redactedapi.unescape(group['group']['name']), group['group']['year']))
+    if not os.path.exists(flac_dir):
+        os.makedirs(flac_dir)
+    shutil.copy(flac_file, flac_dir)
+    return flac_dir
+
+
+def confirm_flac_dir(flac_dir: str, skip_missing: bool) -> Optional[str]:
+    '''
+    Returns flac_dir, or an alternative the user supplies if it doesn't
+    exist. Returns None if the release should be skipped.
+    '''
+    while not Path(flac_dir).exists():
+        if skip_missing:
+            print(f'Could not find flac dir {flac_dir}. Skipping.')
+            return None
+        else:
+            print(f'Could not find flac dir {flac_dir}')
+        alternative_file_path_exists = ""
+        while (alternative_file_path_exists.lower() != "y") and (alternative_file_path_exists.lower() != "n"):
+            alternative_file_path_exists = input("Do you wish to provide an alternative file path? (y/n): ")
+
+        if alternative_file_path_exists.lower() == "y":
+            flac_dir = input("Alternative file path: ")
+        else:
+            print("Skipping: %s" % flac_dir)
+            return None
+    return flac_dir
+
+
+def discover(run: Run, groupid, torrentid, group, interactive: bool) -> Optional[dict]:
+    '''
+    Finds a candidate's source files and works out which formats it
+    needs. Returns its release entry, or None if it was skipped.
+    '''
+    torrent = [t for t in group['torrents'] if t['id'] == torrentid][0]
+    entry = release_entry(run.api, groupid, group, torrent)
+    print(f'\nTorrent ID: {torrentid} - {entry["artist"]} - {entry["title"]}')
+
+    flac_dir = find_flac_dir(run, group, torrent)
+    if flac_dir is None:
+        run.finish(torrentid, 'missing')
+        return None
+
+    try:
+        with run.metrics.span('probe', torrentid=torrentid):
+            multichannel = run.probe(flac_dir).is_multichannel()
+    except Exception:
+        multichannel = False
+    if multichannel:
+        print("This is a multichannel release, which is unsupported - skipping")
+        run.finish(torrentid, 'multichannel')
+        return None
+
+    with run.metrics.span('prompt', torrentid=torrentid):
+        flac_dir = confirm_flac_dir(flac_dir, run.args.skip_missing or not interactive)
+    if flac_dir is None:
+        run.finish(torrentid, 'missing')
+        return None
+
+    needed = formats_needed(group, torrent, run.supported_formats)
+    if len(needed) == 0:
+        run.finish(torrentid, 'formats')
+        print(' -> No formats needed. Skipping.')
+        return None
+    print(" -> Formats needed: %s" % ', '.join(needed))
+
+    entry['flac_dir'] = flac_dir
+    entry['needed'] = needed
+    return entry
+
+
+def check_source_tags(run: Run, flac_dir: str) -> bool:
+    # Do the basic tag checks on the source files to ensure any
+    # uploads won't be reported, but punt on the tracknumber
+    # formatting; problems with tracknumber may be fixable when the
+    # tags are copied.
+    with run.metrics.span('tags', flac_dir=flac_dir):
+        problems, tags = tagging.check_release_tags(run.manifest(flac_dir).paths('.flac'), run.args.threads,
+                                                    check_tracknumber_format=False)
+    if problems:
+        print("FLAC files in this release have unacceptable tags - skipping:")
+        for problem in problems:
+            print(" -> %s" % problem)
+        print("You might be able to trump it.")
+        return False
+    # Only the releases currently being worked on are needed.
+    if len(run.tags) >= 64:
+        del run.tags[next(iter(run.tags))]
+    run.tags[os.path.abspath(flac_dir)] = tags
+    return True
+
+
+def source_hashcheck(run: Run, torrentid, flac_dir: str) -> bool:
+    print("\nRunning Hashcheck...")
+    file_path = Path(tempfile.mkstemp()[1])
+    try:
+        run.api.save_torrent_file(torrentid, file_path)
+        with run.metrics.span('hashcheck', torrentid=torrentid):
+            hashcheck_passed = run_hashcheck(file_path, Path(flac_dir), run.args.hashcheck_threads,
+                                             run.hashchecks)
+    finally:
+        file_path.unlink()
+    if hashcheck_passed:
+        print('Hashcheck passed!')
+    else:
+        print('Hashcheck failed, skipping...')
+    return hashcheck_passed
+
+
+def upload_summary(entry, probe, format, transcode_manifest: ReleaseManifest) -> str:
+    transcode_dir = transcode_manifest.root
+    lines = [
+        f'\nTorrent ready for manual upload!',
+        f'Flac directory: {entry["flac_dir"]}',
+        f'Transcode directory: {transcode_dir}',
+        'Files:',
+    ]
+    lines.extend(transcode_manifest.paths(ignore_dotfiles=False))
+    lines.extend([
+        'Upload info:',
+        f'FLAC URL: {entry["permalink"]}',
+        f'Edition: {entry["edition"]}',
+        f'Format: {format}',
+        'Description:',
+        create_description(probe, format, entry['permalink']) + '\n',
+    ])
+    return '\n'.join(lines)
+
+
+def start_formats(run: Run, entry):
+    '''
+    Queues the transcodes of every format a release needs (just the
+    first with --single) on the worker pool. Returns the ReleaseJob, or
+    False if the release turned out not to need a FLAC transcode after
+    all.
+    '''
+    formats = entry['needed'][:1] if run.args.single else entry['needed']
+    return run.pool.submit(entry['flac_dir'], run.output_dir, entry['basename'], formats,
+                           run.probe(entry['flac_dir']), run.manifest(entry['flac_dir']),
+                           torrent.announce_url(run.api.tracker, run.api.passkey), run.piece_length,
+                           run.tags.get(os.path.abspath(entry['flac_dir'])), interactive=not run.args.batch)
+
+
+def make_formats(run: Run, entry, job=None) -> Optional[List[dict]]:
+    '''
+    Transcodes a release into the formats it needs, starting the job if
+    it hasn't been already, and creates their torrents. Returns what is
+    needed to upload each format, or None if the release turned out not
+    to need a FLAC transcode after all.
+    '''
+    if job is None:
+        job = start_formats(run, entry)
+    if not job:
+        return None
+    if job.skipped:
+        print("Skipping %s - some file(s) in this release were incorrectly marked as 24bit." % ', '.join(job.skipped))
+    formats = list(job.output_dirs)
+    print('Adding formats %s...' % ', '.join(formats), end=' ')
+    print(f'Transcoding...')
+    probe = run.probe(entry['flac_dir'])
+    with run.metrics.span('transcode', torrentid=entry['torrentid'], formats=len(formats)) as span:
+        transcode_dirs = job.wait()
+        span['audio_seconds'] = sum(probe[filename].length for filename in probe)
+    if run.profiler:
+        run.profiler.add_worker_stats(job.profiles)
+    for format, failure in job.failures.items():
+        print(f'Error adding format {format}: {failure}')
+    uploads = []
+    for format, transcode_dir in transcode_dirs.items():
+        transcode_manifest = ReleaseManifest(transcode_dir)
+        print(f'Creating torrent file for {format}...')
+        with run.metrics.span('torrent', torrentid=entry['torrentid'], format=format) as span:
+            transcode.make_torrent(transcode_dir, run.torrent_dir, run.api.tracker, run.api.passkey,
+                                   run.piece_length, transcode_manifest, job.streams.get(format))
+            span['bytes_written'] = transcode_manifest.size
+        uploads.append({
+            'format': format,
+            'transcode_dir': transcode_dir,
+            'summary': upload_summary(entry, run.probe(entry['flac_dir']), format, transcode_manifest),
+        })
+    return uploads
+
+
+def confirm_upload(run: Run, entry, upload):
+    print("Done! Did you upload it?")
+    with run.metrics.span('prompt', torrentid=entry['torrentid']):
+        response = get_input(['y', 'n'])
+    if response == 'y':
+        # The group now has another format, so the cached copy of it is
+        # out of date.
+        run.api.invalidate('torrentgroup', id=entry['groupid'])
+    if response == 'n':
+        print(f'Removing transcode output {upload["transcode_dir"]}')
+        if Path(upload['transcode_dir']).is_dir():
+            shutil.rmtree(upload['transcode_dir'])
+
+
+def process_candidate(run: Run, groupid, torrentid, group):
+    '''Takes a candidate through every stage, asking the user as it goes.'''
+    entry = discover(run, groupid, torrentid, group, interactive=True)
+    if entry is None:
+        return
+    flac_dir = entry['flac_dir']
+
+    if not check_source_tags(run, flac_dir):
+        run.finish(torrentid, 'broken_tags')
+        return
+
+    # Manually validate spectrograms, unless the automatic check is sure
+    # either way
+    verdict = None if run.args.skip_spectral else lossy_verdict(run, flac_dir)
+    if verdict == lossy.LOSSY:
+        run.finish(torrentid, 'lossy')
+        return
+    if not run.args.skip_spectral and verdict != lossy.CLEAN:
+        print("\nGenerating Spectrograms...")
+        # A directory of its own, like those of releases queued for
+        # review, which must be left alone.
+        spectral_dir = str(Path(run.spectral_dir) / str(torrentid))
+        try:
+            spectrograms_ok = validate_spectrograms(flac_dir, spectral_dir, run.args.threads,
+                                                    run.manifest(flac_dir), run.probe(flac_dir), run.metrics)
+        finally:
+            shutil.rmtree(spectral_dir, ignore_errors=True)
+        if not spectrograms_ok:
+            run.finish(torrentid, 'spectrograms')
+            return
+
+    if not run.args.skip_hashcheck:
+        if not source_hashcheck(run, torrentid, flac_dir):
+            run.finish(torrentid, 'hashcheck')
+            return
+
+    if Path(flac_dir).exists():
+        try:
+            uploads = make_formats(run, entry)
+        except Exception as e:
+            print("Error adding formats %s: %s" % (', '.join(entry['needed']), e))
+            uploads = []
+        if uploads is None:
+            print("Skipping - some file(s) in this release were incorrectly marked as 24bit.")
+            run.finish(torrentid, '24bit')
+            return
+        for upload in uploads:
+            print(upload['summary'])
+            confirm_upload(run, entry, upload)
+    run.finish(torrentid, 'done')
+
+
+def queue_candidate(run: Run, queue: WorkQueue, groupid, torrentid, group):
+    '''
+    Takes a candidate through every stage that doesn't need a person,
+    then leaves it in the work queue: waiting for its spectrograms to be
+    reviewed, or to be transcoded if spectrograms are skipped or the
+    automatic lossy check found it clean.
+    '''
+    entry = discover(run, groupid, torrentid, group, interactive=False)
+    if entry is None:
+        return
+    flac_dir = entry['flac_dir']
+
+    if not check_source_tags(run, flac_dir):
+        run.finish(torrentid, 'broken_tags')
+        return
+
+    verdict = None if run.args.skip_spectral else lossy_verdict(run, flac_dir)
+    if verdict == lossy.LOSSY:
+        run.finish(torrentid, 'lossy')
+        return
+    if not run.args.skip_spectral and verdict != lossy.CLEAN:
+        print("\nGenerating Spectrograms...")
+        entry['spectral_dir'] = str(Path(run.spectral_dir) / str(torrentid))
+        with run.metrics.span('spectrograms', torrentid=torrentid):
+            generated = generate_spectrograms(flac_dir, entry['spectral_dir'], run.args.threads,
+                                              run.manifest(flac_dir), run.probe(flac_dir))
+        if not generated:
+            run.finish(torrentid, 'spectrograms')
+            return
+
+    if not run.args.skip_hashcheck:
+        if not source_hashcheck(run, torrentid, flac_dir):
+            if 'spectral_dir' in entry:
+                shutil.rmtree(entry['spectral_dir'], ignore_errors=True)
+            run.finish(torrentid, 'hashcheck')
+            return
+
+    queue.advance(entry, workqueue.REVIEW if 'spectral_dir' in entry else workqueue.APPROVED)
+    run.finish(torrentid, 'queued')
+
+
+def transcode_approved(run: Run, queue: WorkQueue):
+    '''
+    Transcodes every approved release in the work queue, unattended. All
+    of them are queued on the worker pool up front, so that workers move
+    straight on to the next release while torrents are being made.
+    '''
+    approved = queue.in_stage(workqueue.APPROVED)
+    jobs = {}
+    for entry in approved:
+        try:
+            jobs[entry['torrentid']] = start_formats(run, entry)
+        except Exception as e:
+            jobs[entry['torrentid']] = e
+
+    for entry in approved:
+        torrentid = entry['torrentid']
+        print(f'\nTorrent ID: {torrentid} - {entry["artist"]} - {entry["title"]}')
+        status = 'done'
+        if isinstance(jobs[torrentid], transcode.PathTooLongException):
+            # Nobody is there to pick a shorter name in batch mode.
+            print(f'Leaving it queued: {jobs[torrentid]}. Run with --review to choose a shorter name.')
+            continue
+        try:
+            job = jobs[torrentid]
+            if isinstance(job, Exception):
+                raise job
+            with run.profile(f'{torrentid}-transcode'):
+                uploads = make_formats(run, entry, job)
+        except Exception as e:
+            print("Error adding formats %s: %s" % (', '.join(entry['needed']), e))
+            uploads = []
+        if uploads is None:
+            print("Skipping - some file(s) in this release were incorrectly marked as 24bit.")
+            status = '24bit'
+        elif uploads:
+            entry['uploads'] = uploads
+            queue.advance(entry, workqueue.READY)
+        if not uploads:
+            queue.delete(torrentid)
+        run.finish(torrentid, status)
+
+
+def review(run: Run, queue: WorkQueue):
+    '''
+    Asks the user about the spectrograms of every release waiting for
+    review, then transcodes the ones that were approved.
+    '''
+    pending = queue.in_stage(workqueue.REVIEW)
+    print(f'{len(pending)} release(s) waiting for spectrogram review:')
+    for entry in pending:
+        print(f'{entry["torrentid"]} - {entry["artist"]} - {entry["title"]}: {entry["spectral_dir"]}')
+
+    for entry in pending:
+        torrentid = entry['torrentid']
+        print(f'\nTorrent ID: {torrentid} - {entry["artist"]} - {entry["title"]}')
+        print(f'Spectrograms are in {entry["spectral_dir"]}. Are they acceptable? '
+              f'(s leaves them for later)')
+        with run.metrics.span('prompt', torrentid=torrentid):
+            response = get_input(['y', 'n', 's'])
+        if response == 's':
+            continue
+        shutil.rmtree(entry['spectral_dir'], ignore_errors=True)
+        if response == 'y':
+            queue.advance(entry, workqueue.APPROVED)
+        else:
+            print(f'Spectrograms rejected.')
+            queue.delete(torrentid)
+            run.finish(torrentid, 'spectrograms')
+
+    transcode_approved(run, queue)
+
+
+def uploads(run: Run, queue: WorkQueue):
+    '''Shows the upload details of every transcoded release in the work queue.'''
+    for entry in queue.in_stage(workqueue.READY):
+        print(f'\nTorrent ID: {entry["torrentid"]} - {entry["artist"]} - {entry["title"]}')
+        for upload in entry['uploads']:
+            print(upload['summary'])
+            confirm_upload(run, entry, upload)
+        queue.delete(entry['torrentid'])
+
+
+def find_candidates(run: Run, queue: WorkQueue):
+    args = run.args
+    api = run.api
+    cache = run.cache
+
+    print('Searching for transcode candidates...')
+    retry_modes = set(args.retry)
+    if args.release_urls:
+        print('You supplied one or more release URLs, ignoring your configuration\'s media types.')
+        candidates = [(int(query['id']), int(query['torrentid'])) for query in\
+                [dict(urlparse.parse_qsl(urlparse.urlparse(url).query)) for url in args.release_urls]]
+    else:
+        added = run.snatched.sync(api)
+        print(f'Found {added} new snatched torrent(s), {len(run.snatched)} in total.')
+        candidates = run.snatched.candidates(cache.ids, retry_modes)
+
+    def skip(torrentid):
+        if torrentid in cache.ids:
+            retry = False
+            if cache.ids[torrentid] in retry_modes:
+                retry = True
+            if not retry:
+                return f'Torrent ID {torrentid} present in cache. Skipping.'
+        return None
+
+    for groupid, torrentid, group, skipped in Prefetcher(api, candidates, skip, args.prefetch, args.refresh):
+        if skipped:
+            print(skipped)
+            continue
+        if group is None:
+            continue
+        with run.metrics.span('candidate', torrentid=torrentid), run.profile(torrentid):
+            if args.batch:
+                queue_candidate(run, queue, groupid, torrentid, group)
+            else:
+                process_candidate(run, groupid, torrentid, group)
+        run.metrics.write_textfile()
+
+    if args.batch:
+        transcode_approved(run, queue)
+        print(f'\n{len(queue.in_stage(workqueue.REVIEW))} release(s) waiting for review (--review), '
+              f'{len(queue.in_stage(workqueue.READY))} ready to upload (--uploads).')
+
+
 def main():
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -147,7 +730,7 @@ def main():
         '-j',
         '--threads',
         type=int,
-        help='number of threads to use when transcoding',
+        help='number of threads to use when transcoding and making spectrograms',
         default=max(cpu_count() - 1, 1)
     )
     parser.add_argument(
@@ -160,6 +743,53 @@ def main():
         help='the location of the cache',
         default=Path('./.redactedbetter/cache').expanduser()
     )
+    parser.add_argument(
+        '--response-cache',
+        help='the directory where API responses are cached',
+        default=Path('./.redactedbetter/responses').expanduser()
+    )
+    parser.add_argument(
+        '--refresh',
+        action='store_true',
+        default=False,
+        help='Fetch torrent groups again instead of using cached API responses'
+    )
+    parser.add_argument(
+        '--refresh-group',
+        type=int,
+        action='append',
+        metavar='GROUP_ID',
+        help='Fetch this torrent group again instead of using its cached API response (can be repeated)'
+    )
+    parser.add_argument(
+        '--prefetch',
+        type=int,
+        help='Number of torrent groups to fetch ahead of the one being processed',
+        default=10
+    )
+    parser.add_argument(
+        '--artifact-cache',
+        help='the directory where encoded files are kept for reuse',
+        default=Path('./.redactedbetter/artifacts').expanduser()
+    )
+    parser.add_argument(
+        '--artifact-cache-size',
+        type=float,
+        help='the size in GiB the artifact cache is trimmed to (0 disables it)',
+        default=10
+    )
+    parser.add_argument(
+        '--staging-dir',
+        help='a fast local directory (e.g. /dev/shm) to transcode and hash releases in before moving them '
+             'into output_dir',
+        default=None
+    )
+    parser.add_argument(
+        '--staging-size',
+        type=float,
+        help='the size in GiB of the transcodes the staging directory may hold at once',
+        default=4
+    )
     parser.add_argument(
         '-p',
         '--page-size',
@@ -186,12 +816,84 @@ def main():
         default=False,
         help='Skips spectrograph verification'
     )
+    parser.add_argument(
+        '--auto-spectral',
+        action='store_true',
+        default=False,
+        help='Reject clearly lossy sources and pass clearly clean ones without showing their spectrograms'
+    )
     parser.add_argument(
         '--skip-hashcheck',
         action='store_true',
         default=False,
         help='Skip source file integrity verification'
     )
+    parser.add_argument(
+        '--hashcheck-threads',
+        type=int,
+        help='number of files to read at once when verifying source files',
+        default=hashcheck.default_threads
+    )
+    parser.add_argument(
+        '--hashcheck-cache',
+        help='the location of the record of source files that have passed a hashcheck',
+        default=Path('./.redactedbetter/hashchecks').expanduser()
+    )
+    parser.add_argument(
+        '--snatched-index',
+        help='the location of the index of snatched torrents',
+        default=Path('./.redactedbetter/snatched').expanduser()
+    )
+    parser.add_argument(
+        '--data-index',
+        help='the location of the index of the directories under data_dir and extra_data_dirs',
+        default=Path('./.redactedbetter/dataindex').expanduser()
+    )
+    parser.add_argument(
+        '--queue',
+        help='the location of the batch work queue',
+        default=Path('./.redactedbetter/queue').expanduser()
+    )
+    parser.add_argument(
+        '--metrics',
+        help='a JSON lines file to append the timing of every stage of the run to'
+    )
+    parser.add_argument(
+        '--metrics-textfile',
+        help='a Prometheus textfile to keep the totals of each stage in, for node_exporter'
+    )
+    parser.add_argument(
+        '--profile',
+        nargs='?',
+        const=Path('./.redactedbetter/profiles').expanduser(),
+        help='profile every candidate, including its transcode workers, into this directory '
+             '(.redactedbetter/profiles if not given)'
+    )
+    parser.add_argument(
+        '--profile-top',
+        type=int,
+        help='how many functions and allocations to list in profile summaries',
+        default=default_top
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        '--batch',
+        action='store_true',
+        default=False,
+        help='Run every unattended stage and queue releases for review instead of prompting'
+    )
+    mode.add_argument(
+        '--review',
+        action='store_true',
+        default=False,
+        help='Review queued spectrograms, then transcode the approved releases'
+    )
+    mode.add_argument(
+        '--uploads',
+        action='store_true',
+        default=False,
+        help='Show the upload details of queued releases that have been transcoded'
+    )
 
     args = parser.parse_args()
 
@@ -212,9 +914,14 @@ def main():
         config.get('redacted', 'output_dir', fallback=data_dir)
     ).expanduser()
     torrent_dir = Path(config.get('redacted', 'torrent_dir')).expanduser()
+    data_roots = [data_dir] + [Path(root.strip()).expanduser()
+                               for root in config.get('redacted', 'extra_data_dirs', fallback='').split(',')
+                               if root.strip()]
     supported_formats = [format.strip().upper() for format in config.get('redacted', 'formats').split(',')]
     validate_formats(supported_formats)
 
+    metrics = Metrics(args.metrics and Path(args.metrics), args.metrics_textfile and Path(args.metrics_textfile))
+
     print('Logging in to RED...')
     api = redactedapi.RedactedAPI(
         args.page_size,
@@ -222,186 +929,64 @@ def main():
         password,
         session_cookie,
         api_key,
+        redactedapi.ResponseCache(Path(args.response_cache)),
+        base_url=config.get('redacted', 'base_url', fallback='') or redactedapi.default_base_url,
+        tracker=config.get('redacted', 'tracker', fallback='') or redactedapi.default_tracker,
+        metrics=metrics,
     )
+    for groupid in args.refresh_group or []:
+        api.invalidate('torrentgroup', id=groupid)
 
     cache_path = Path(args.cache)
     cache = Cache.from_file(cache_path)
     spectral_dir = Path(config.get('redacted', 'spectral_dir', fallback='/tmp/spectrograms'))
     spectral_dir.mkdir(parents=True, exist_ok=True)
+    queue = WorkQueue(Path(args.queue))
 
-    print('Searching for transcode candidates...')
-    if args.release_urls:
-        print('You supplied one or more release URLs, ignoring your configuration\'s media types.')
-        candidates = [(int(query['id']), int(query['torrentid'])) for query in\
-                [dict(urlparse.parse_qsl(urlparse.urlparse(url).query)) for url in args.release_urls]]
-    else:
-        candidates = api.snatched()
-    retry_modes = set(args.retry)
+    if args.uploads:
+        uploads(Run(args, api, cache, cache_path, data_dir, output_dir, torrent_dir, spectral_dir,
+                    supported_formats, config.get('redacted', 'piece_length'), None, metrics=metrics), queue)
+        metrics.close()
+        return
 
-    for groupid, torrentid in candidates:
-        if torrentid in cache.ids:
-            retry = False
-            if cache.ids[torrentid] in retry_modes:
-                retry = True
-            if not retry:
-                print(f'Torrent ID {torrentid} present in cache. Skipping.')
-                continue
-        group = api.request('torrentgroup', id=groupid)
-        if group != None:
-            torrent = [t for t in group['torrents'] if t['id'] == torrentid][0]
-
-            if len(group['group']['musicInfo']['artists']) > 1:
-                artist = "Various Artists"
-            else:
-                artist = group['group']['musicInfo']['artists'][0]['name']
-
-            year = str(torrent['remasterYear'])
-            if year == "0":
-                year = str(group['group']['year'])
-            
-            title = group['group']['name']
-            print(f'\nTorrent ID: {torrentid} - {artist} - {title}')
-
-            if not torrent['filePath']:
-                flac_file = os.path.join(data_dir, redactedapi.unescape(torrent['fileList']).split('{{{')[0])
-                if not Path(flac_file).exists():
-                    print("Path not found - skipping: %s" % flac_file)
-                    cache.add(torrentid, 'missing', cache_path)
-                    continue
-                flac_dir = os.path.join(data_dir, "%s (%s) [FLAC]" % (
-                    redactedapi.unescape(group['group']['name']), group['group']['year']))
-                if not os.path.exists(flac_dir):
-                    os.makedirs(flac_dir)
-                shutil.copy(flac_file, flac_dir)
-            else:
-                flac_dir = os.path.join(data_dir, redactedapi.unescape(torrent['filePath']))
-
-            if transcode.is_multichannel(flac_dir):
-                print("This is a multichannel release, which is unsupported - skipping")
-                cache.add(torrentid, 'multichannel', cache_path)
-                continue
-
-            has_valid_dir = True
-            while not Path(flac_dir).exists():
-                if args.skip_missing:
-                    print(f'Could not find flac dir {flac_dir}. Skipping.')
-                    has_valid_dir = False
-                    break
-                else:
-                    print(f'Could not find flac dir {flac_dir}')
-                alternative_file_path_exists = ""
-                while (alternative_file_path_exists.lower() != "y") and (alternative_file_path_exists.lower() != "n"):
-                    alternative_file_path_exists = input("Do you wish to provide an alternative file path? (y/n): ")
-
-                if alternative_file_path_exists.lower() == "y":
-                    flac_dir = input("Alternative file path: ")
-                else:
-                    print("Skipping: %s" % flac_dir)
-                    has_valid_dir = False
-                    break
-
-            if not has_valid_dir:
-                cache.add(torrentid, 'missing', cache_path)
-                continue
-
-            needed = formats_needed(group, torrent, supported_formats)
-
-            if len(needed) == 0:
-                cache.add(torrentid, 'formats', cache_path)
-                print(' -> No formats needed. Skipping.')
-                continue
+    store = None
+    if args.artifact_cache_size > 0:
+        store = ArtifactStore(Path(args.artifact_cache), int(args.artifact_cache_size * (1 << 30)))
+
+    profiler = Profiler(Path(args.profile), args.profile_top) if args.profile else None
+
+    staging = None
+    if args.staging_dir:
+        staging = Staging(Path(args.staging_dir).expanduser(), int(args.staging_size * (1 << 30)))
+
+    try:
+        with transcode.TranscodePool(args.threads, store, metrics, profiler and profiler.worker_dir, staging) as pool:
+            run = Run(args, api, cache, cache_path, data_dir, output_dir, torrent_dir, spectral_dir,
+                      supported_formats, config.get('redacted', 'piece_length'), pool,
+                      HashcheckCache(Path(args.hashcheck_cache)), SnatchedIndex(Path(args.snatched_index)),
+                      DataIndex(Path(args.data_index), data_roots), metrics, profiler)
+            if args.review:
+                review(run, queue)
             else:
-                print(" -> Formats needed: %s" % ', '.join(needed))
-
-            # Before proceeding, do the basic tag checks on the source
-            # files to ensure any uploads won't be reported, but punt
-            # on the tracknumber formatting; problems with tracknumber
-            # may be fixable when the tags are copied.
-            broken_tags = False
-            for flac_file in transcode.locate(flac_dir, transcode.ext_matcher('.flac')):
-                (ok, msg) = tagging.check_tags(flac_file, check_tracknumber_format=False)
-                if not ok:
-                    print("A FLAC file in this release has unacceptable tags - skipping: %s" % msg)
-                    print("You might be able to trump it.")
-                    broken_tags = True
-                    break
-            if broken_tags:
-                cache.add(torrentid, 'broken_tags', cache_path)
-                continue
-
-            # Manually validate spectrograms
-            if not args.skip_spectral:
-                print("\nGenerating Spectrograms...")
-                spectrograms_ok = validate_spectrograms(flac_dir, spectral_dir, args.threads)
-                if not spectrograms_ok:
-                    cache.add(torrentid, 'spectrograms', cache_path)
-                    continue
-
-            if not args.skip_hashcheck:
-                print("\nRunning Hashcheck...")
-                file_path = Path(tempfile.mkstemp()[1])
-                try:
-                    api.save_torrent_file(torrentid, file_path)
-                    hashcheck_passed = run_hashcheck(file_path, Path(flac_dir))
-                finally:
-                    file_path.unlink()
-                if hashcheck_passed:
-                    print('Hashcheck passed!')
-                else:
-                    cache.add(torrentid, 'hashcheck', cache_path)
-                    print('Hashcheck failed, skipping...')
-                    continue
-
-            for format in needed:
-                if Path(flac_dir).exists():
-                    print('Adding format %s...' % format, end=' ')
-                    tmpdir = tempfile.mkdtemp()
-                    try:
-                        if len(torrent['remasterTitle']) >= 1:
-                            basename = artist + " - " + group['group']['name'] + " (" + torrent['remasterTitle'] + ") " + "[" + year + "] (" + torrent['media'] + " - "
-                        else:
-                            basename = artist + " - " + group['group']['name'] + " [" + year + "] (" + torrent['media'] + " - "
-
-                        print(f'Transcoding...')
-                        transcode_dir = transcode.transcode_release(flac_dir, output_dir, basename, format, max_threads=args.threads)
-                        if not transcode_dir:
-                            print("Skipping - some file(s) in this release were incorrectly marked as 24bit.")
-                            cache.add(torrentid, '24bit', cache_path)
-                            break
-
-                        print('Creating torrent file...')
-                        new_torrent = transcode.make_torrent(transcode_dir, tmpdir, api.tracker, api.passkey, config.get('redacted', 'piece_length'))
-
-                        permalink = api.permalink(torrent)
-                        print(f'\nTorrent ready for manual upload!')
-                        print(f'Flac directory: {flac_dir}')
-                        print(f'Transcode directory: {transcode_dir}')
-                        print('Files:')
-                        for file_name in Path(transcode_dir).glob('**/*'):
-                            print(file_name)
-                        print('Upload info:')
-                        print(f'FLAC URL: {permalink}')
-                        print(f'Edition: {year} - {torrent["remasterRecordLabel"]}')
-                        print(f'Format: {format}')
-                        description = create_description(torrent, flac_dir,
-                                                         format, permalink)
-                        print('Description:')
-                        print(f'{description}\n')
-
-                        shutil.copy(new_torrent, torrent_dir)
-                        print("Done! Did you upload it?")
-                        response = get_input(['y', 'n'])
-                        if response == 'n':
-                            print(f'Removing transcode output {transcode_dir}')
-                            if Path(transcode_dir).is_dir():
-                                Path(transcode_dir).rmdir()
-                        if args.single:
-                            break
-                    except Exception as e:
-                        print("Error adding format %s: %s" % (format, e))
-                    finally:
-                        shutil.rmtree(tmpdir)
-            cache.add(torrentid, 'done', cache_path)
+                find_candidates(run, queue)
+    finally:
+        if staging:
+            staging.close()
+
+    limiter = api.rate_limiter.stats()
+    print(f'Made {limiter["requests"]} API requests, waiting {limiter["wait_time"]:.0f}s '
+          f'for the rate limit and backing off {limiter["backoffs"]} time(s).')
+    if store:
+        artifacts = store.stats()
+        print(f'Reused {artifacts["hits"]} of {artifacts["hits"] + artifacts["misses"]} '
+              f'transcoded files from the artifact cache.')
+    speed = metrics.speed('transcode')
+    if speed:
+        print(f'Transcoded {metrics.totals["transcode"]["audio_seconds"]:.0f}s of audio at {speed:.1f}x real time.')
+    metrics.close()
+    if profiler:
+        print(f'\nProfiles written to {args.profile}.')
+        print(profiler.summary())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,57 @@
+import os
+from collections import namedtuple
+
+ManifestEntry = namedtuple('ManifestEntry', ['path', 'relpath', 'size', 'mtime', 'ext'])
+
+
+class ReleaseManifest:
+    '''
+    Every file in a release directory, found in a single os.scandir walk
+    so that the steps which need to list the release can share it
+    instead of walking the directory again.
+
+    Entries are sorted by their path relative to the root. Like locate(),
+    unreadable directories are skipped rather than raising. Symlinks to
+    files are followed, but like os.walk() symlinks to directories are
+    not, so a link back up the tree can't send the walk round forever.
+    '''
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.entries = []
+        pending = [self.root]
+        while pending:
+            directory = pending.pop()
+            try:
+                with os.scandir(directory) as it:
+                    for dir_entry in it:
+                        if dir_entry.is_dir(follow_symlinks=False):
+                            pending.append(dir_entry.path)
+                        elif dir_entry.is_file(follow_symlinks=True):
+                            stat = dir_entry.stat()
+                            self.entries.append(ManifestEntry(
+                                path=dir_entry.path,
+                                relpath=os.path.relpath(dir_entry.path, self.root),
+                                size=stat.st_size,
+                                mtime=stat.st_mtime,
+                                ext=os.path.splitext(dir_entry.name)[1].lower(),
+                            ))
+            except OSError:
+                continue
+        self.entries.sort(key=lambda entry: entry.relpath)
+
+    def files(self, *extensions, ignore_dotfiles=True):
+        '''
+        Returns the entries with one of the given extensions, or every
+        entry if none are given.
+        '''
+        return [entry for entry in self.entries
+                if (not extensions or entry.ext in extensions)
+                and not (ignore_dotfiles and os.path.basename(entry.path).startswith('.'))]
+
+    def paths(self, *extensions, ignore_dotfiles=True):
+        return [entry.path for entry in self.files(*extensions, ignore_dotfiles=ignore_dotfiles)]
+
+    @property
+    def size(self):
+        return sum(entry.size for entry in self.entries)
@@ -0,0 +1,100 @@
+'''
+Timing of the stages of a run. Each span (a stage, how long it took
+and what it did, e.g. bytes read) is appended to a JSON lines file as
+it finishes, and totals per stage can be written as a Prometheus
+textfile for node_exporter's textfile collector.
+'''
+import json
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+from red_better.cache import atomic_write
+
+# Span fields that are added up per stage.
+counted_fields = ['bytes_read', 'bytes_written', 'audio_seconds']
+
+
+class Metrics:
+    '''
+    Spans recorded from any thread. With no jsonl_path nothing is written
+    as spans finish, but totals are still kept.
+    '''
+
+    def __init__(self, jsonl_path: Optional[Path] = None, textfile_path: Optional[Path] = None):
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.jsonl = None
+        if jsonl_path is not None:
+            Path(jsonl_path).parent.mkdir(parents=True, exist_ok=True)
+            self.jsonl = open(str(jsonl_path), 'a')
+        self.textfile_path = Path(textfile_path) if textfile_path is not None else None
+
+    @contextmanager
+    def span(self, stage, **fields):
+        '''
+        Times the body of a with block as a span of stage. The dict it
+        yields can be filled in with more fields (such as bytes_read) on
+        the way.
+        '''
+        start = time.time()
+        began = time.perf_counter()
+        extra = {}
+        try:
+            yield extra
+        finally:
+            fields.update(extra)
+            self.record(stage, time.perf_counter() - began, start, **fields)
+
+    def record(self, stage, seconds, start=None, **fields):
+        '''Records a span that was timed elsewhere, e.g. in a pool worker.'''
+        line = dict(fields, stage=stage, start=start if start is not None else time.time() - seconds,
+                    seconds=seconds)
+        with self.lock:
+            totals = self.totals.setdefault(stage, dict({'count': 0, 'seconds': 0.0},
+                                                        **{field: 0 for field in counted_fields}))
+            totals['count'] += 1
+            totals['seconds'] += seconds
+            for field in counted_fields:
+                totals[field] += fields.get(field, 0)
+            if self.jsonl is not None:
+                self.jsonl.write(json.dumps(line) + '\n')
+                self.jsonl.flush()
+
+    def speed(self, stage) -> Optional[float]:
+        '''Returns the audio seconds a stage got through per wall second.'''
+        totals = self.totals.get(stage)
+        if not totals or not totals['seconds'] or not totals['audio_seconds']:
+            return None
+        return totals['audio_seconds'] / totals['seconds']
+
+    def write_textfile(self):
+        if self.textfile_path is None:
+            return
+        with self.lock:
+            totals = {stage: dict(stage_totals) for stage, stage_totals in self.totals.items()}
+        lines = []
+        for name, field, kind, help in [
+                ('redbetter_stage_runs_total', 'count', 'counter', 'Spans of each stage.'),
+                ('redbetter_stage_seconds_total', 'seconds', 'counter', 'Wall-clock seconds spent in each stage.'),
+                ('redbetter_bytes_read_total', 'bytes_read', 'counter', 'Bytes read by each stage.'),
+                ('redbetter_bytes_written_total', 'bytes_written', 'counter', 'Bytes written by each stage.'),
+                ('redbetter_audio_seconds_total', 'audio_seconds', 'counter', 'Seconds of audio handled by each stage.'),
+        ]:
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for stage, stage_totals in sorted(totals.items()):
+                lines.append(f'{name}{{stage="{stage}"}} {stage_totals[field]}')
+        lines.append('# HELP redbetter_last_update_seconds When these metrics were written.')
+        lines.append('# TYPE redbetter_last_update_seconds gauge')
+        lines.append(f'redbetter_last_update_seconds {time.time():.3f}')
+        self.textfile_path.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(self.textfile_path, '\n'.join(lines) + '\n')
+
+    def close(self):
+        self.write_textfile()
+        if self.jsonl is not None:
+            self.jsonl.close()
+            self.jsonl = None
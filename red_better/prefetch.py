@@ -0,0 +1,139 @@
+import asyncio
+import queue
+import threading
+from collections import deque
+
+from red_better import aioredactedapi
+
+
+class Prefetcher:
+    '''
+    Iterates over (groupid, torrentid, group, skipped) for every
+    candidate, fetching the torrent groups in a background thread so
+    that moving on to the next candidate doesn't have to wait on the API.
+
+    skip(torrentid) returns why a candidate should be skipped, or None.
+    A skipped candidate comes through with no group and that reason, so
+    that the reason is printed by the consumer, in order, rather than by
+    the background thread in the middle of a prompt.
+
+    At most lookahead groups are fetched ahead of the one being
+    processed. With a lookahead of 0 groups are fetched on demand.
+
+    When aiohttp is installed, up to lookahead groups are requested at
+    once rather than one after another, still spaced by the shared rate
+    limiter, so the latency of one request no longer holds up the next.
+    '''
+
+    _done = object()
+
+    def __init__(self, api, candidates, skip, lookahead=10, refresh=False):
+        self.api = api
+        self.candidates = candidates
+        self.skip = skip
+        self.lookahead = lookahead
+        self.refresh = refresh
+        self.queue = queue.Queue(maxsize=max(lookahead, 1))
+        self.stopped = threading.Event()
+
+    def _fetch(self):
+        for groupid, torrentid in self.candidates:
+            skipped = self.skip(torrentid)
+            if skipped:
+                yield groupid, torrentid, None, skipped
+                continue
+            group = self.api.request('torrentgroup', refresh=self.refresh, id=groupid)
+            yield groupid, torrentid, group, None
+
+    def _next_candidate(self, candidates):
+        for groupid, torrentid in candidates:
+            return groupid, torrentid, self.skip(torrentid)
+        return None
+
+    async def _hand_over(self, pending) -> bool:
+        groupid, torrentid, group, skipped = pending.popleft()
+        item = (groupid, torrentid, None if group is None else await group, skipped)
+        # Blocks in another thread, so the requests still in flight go on.
+        return await asyncio.get_event_loop().run_in_executor(None, self._put, item)
+
+    async def _fetch_concurrently(self):
+        async with aioredactedapi.AsyncRedactedAPI.like(self.api, max_connections=self.lookahead) as api:
+            loop = asyncio.get_event_loop()
+            candidates = iter(self.candidates)
+            pending = deque()
+            try:
+                while True:
+                    # Groups already handed over count towards lookahead, so
+                    # that no more requests are made than the sync fetch would
+                    # (each takes its slot with the rate limiter, even if it
+                    # is cancelled). Skipped candidates make no request and
+                    # are handed over as soon as they reach the front.
+                    in_flight = sum(1 for _, _, group, _ in pending if group is not None)
+                    if pending and (in_flight >= max(self.lookahead - self.queue.qsize(), 1)
+                                    or pending[0][2] is None):
+                        if not await self._hand_over(pending):
+                            return
+                        continue
+                    # skip() checks the cache and the disk, which would hold
+                    # up the requests in flight.
+                    candidate = await loop.run_in_executor(None, self._next_candidate, candidates)
+                    if candidate is None:
+                        break
+                    groupid, torrentid, skipped = candidate
+                    if skipped:
+                        pending.append((groupid, torrentid, None, skipped))
+                        continue
+                    request = api.request('torrentgroup', refresh=self.refresh, id=groupid)
+                    pending.append((groupid, torrentid, asyncio.ensure_future(request), None))
+                while pending:
+                    if not await self._hand_over(pending):
+                        return
+            finally:
+                requests = [group for _, _, group, _ in pending if group is not None]
+                for group in requests:
+                    group.cancel()
+                await asyncio.gather(*requests, return_exceptions=True)
+
+    def _put(self, item) -> bool:
+        # Wake up now and then so that an abandoned iteration doesn't
+        # leave this thread blocked forever.
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        try:
+            if aioredactedapi.available():
+                asyncio.run(self._fetch_concurrently())
+                if self.stopped.is_set():
+                    return
+            else:
+                for item in self._fetch():
+                    if not self._put(item):
+                        return
+        except Exception as e:
+            self._put(e)
+            return
+        self._put(self._done)
+
+    def __iter__(self):
+        if self.lookahead <= 0:
+            yield from self._fetch()
+            return
+
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = self.queue.get()
+                if item is self._done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.stopped.set()
@@ -0,0 +1,108 @@
+import struct
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# Releases with more FLACs than this are probed from several threads,
+# which mostly helps when the files are on a network mount.
+PARALLEL_THRESHOLD = 16
+PROBE_THREADS = 8
+
+
+class StreamInfoError(Exception):
+    pass
+
+
+class StreamInfo(namedtuple('StreamInfo', ['sample_rate', 'channels', 'bits_per_sample', 'total_samples', 'md5'])):
+    __slots__ = ()
+
+    @property
+    def length(self):
+        '''The duration in seconds.'''
+        return self.total_samples / self.sample_rate if self.sample_rate else 0.0
+
+
+def read_streaminfo(flac_file) -> StreamInfo:
+    '''
+    Reads the STREAMINFO block of a FLAC file, which the format requires
+    to be the first metadata block, without parsing anything else.
+    '''
+    with open(flac_file, 'rb') as f:
+        header = f.read(10)
+        # Some taggers put an ID3v2 tag in front of the stream.
+        if header[:3] == b'ID3':
+            size = 0
+            for byte in header[6:10]:
+                size = (size << 7) | (byte & 0x7f)
+            f.seek(10 + size)
+        else:
+            f.seek(0)
+        header = f.read(42)
+
+    if header[:4] != b'fLaC' or len(header) < 42:
+        raise StreamInfoError(f'"{flac_file}" is not a FLAC file')
+    if header[4] & 0x7f != 0:
+        raise StreamInfoError(f'"{flac_file}" does not start with a STREAMINFO block')
+
+    # After the block and frame size limits come 64 bits holding the
+    # sample rate (20), channels - 1 (3), bits per sample - 1 (5) and
+    # the total number of samples (36), followed by the MD5 of the audio.
+    (packed,) = struct.unpack('>Q', header[18:26])
+    return StreamInfo(
+        sample_rate=packed >> 44,
+        channels=((packed >> 41) & 0x7) + 1,
+        bits_per_sample=((packed >> 36) & 0x1f) + 1,
+        total_samples=packed & 0xfffffffff,
+        md5=header[26:42].hex(),
+    )
+
+
+class ReleaseProbe:
+    '''
+    The stream properties of every FLAC in a release, read once and then
+    answered from memory.
+    '''
+
+    def __init__(self, flac_files, threads=PROBE_THREADS):
+        flac_files = list(flac_files)
+        if len(flac_files) > PARALLEL_THRESHOLD and threads > 1:
+            with ThreadPoolExecutor(threads) as executor:
+                infos = list(executor.map(read_streaminfo, flac_files))
+        else:
+            infos = [read_streaminfo(flac_file) for flac_file in flac_files]
+        self.infos = dict(zip(flac_files, infos))
+
+    def __getitem__(self, flac_file) -> StreamInfo:
+        return self.infos[flac_file]
+
+    def __iter__(self):
+        return iter(self.infos)
+
+    def is_24bit(self):
+        '''Returns True if any FLAC in the release is 24 bit.'''
+        return any(info.bits_per_sample > 16 for info in self.infos.values())
+
+    def is_multichannel(self):
+        '''Returns True if any FLAC in the release is multichannel.'''
+        return any(info.channels > 2 for info in self.infos.values())
+
+    def needs_resampling(self):
+        '''Returns True if any FLAC in the release needs resampling when transcoded.'''
+        return self.is_24bit()
+
+    def resample_rate(self):
+        '''Returns the rate to which the release should be resampled.'''
+        original_rate = max(info.sample_rate for info in self.infos.values())
+        if original_rate % 44100 == 0:
+            return 44100
+        elif original_rate % 48000 == 0:
+            return 48000
+        else:
+            return None
+
+    def cost(self, flac_file):
+        '''
+        Estimates how long a file takes to transcode relative to the
+        others, from its duration and sample rate.
+        '''
+        info = self.infos[flac_file]
+        return info.length * info.sample_rate
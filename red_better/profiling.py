@@ -0,0 +1,142 @@
+'''
+cProfile stats and tracemalloc peaks of each candidate, including the
+time its files spend in transcode pool workers. Workers dump the stats
+of each file they transcode into a directory of their own, and those
+are merged into the .pstats file of the candidate they belong to.
+'''
+import cProfile
+import io
+import os
+import pstats
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+default_top = 25
+
+CandidateProfile = namedtuple('CandidateProfile', ['name', 'seconds', 'peak_memory', 'path'])
+
+# Set in pool workers by start_worker.
+worker_dir = None
+
+
+def start_worker(profile_dir: Optional[str]):
+    '''Makes a pool worker profile the files it transcodes into profile_dir.'''
+    global worker_dir
+    worker_dir = profile_dir
+    if worker_dir is not None:
+        tracemalloc.start()
+
+
+def reset_peak():
+    # tracemalloc.reset_peak() is new in Python 3.9; before that, peaks
+    # are since tracing started.
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+
+
+@contextmanager
+def worker_profile(timing):
+    '''
+    Profiles the body of a with block in a pool worker, if profiling, and
+    yields a list that holds the path of its stats afterwards. The peak
+    memory is added to timing.
+    '''
+    paths = []
+    if worker_dir is None:
+        yield paths
+        return
+    profile = cProfile.Profile()
+    reset_peak()
+    profile.enable()
+    try:
+        yield paths
+    finally:
+        profile.disable()
+        timing['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        fd, path = tempfile.mkstemp(dir=worker_dir, prefix=f'{os.getpid()}-', suffix='.pstats')
+        os.close(fd)
+        profile.dump_stats(path)
+        paths.append(path)
+
+
+class Profiler:
+    '''
+    Writes <name>.pstats (the parent's stats merged with those of its
+    pool workers) and <name>.memory.txt (the largest allocations at the
+    end) for each candidate into profile_dir.
+    '''
+
+    def __init__(self, profile_dir: Path, top=default_top):
+        self.profile_dir = Path(profile_dir)
+        self.worker_dir = self.profile_dir / 'workers'
+        self.worker_dir.mkdir(parents=True, exist_ok=True)
+        self.top = top
+        self.candidates = []
+        self.worker_stats = None
+        tracemalloc.start()
+
+    @contextmanager
+    def candidate(self, name):
+        '''Profiles the body of a with block as the candidate name.'''
+        self.worker_stats = []
+        profile = cProfile.Profile()
+        reset_peak()
+        began = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            seconds = time.perf_counter() - began
+            peak = tracemalloc.get_traced_memory()[1]
+            worker_stats, self.worker_stats = self.worker_stats, None
+            path = self.profile_dir / f'{name}.pstats'
+            stats = pstats.Stats(profile)
+            for worker_path in worker_stats:
+                try:
+                    stats.add(worker_path)
+                    os.unlink(worker_path)
+                except (OSError, TypeError, EOFError):
+                    continue
+            stats.dump_stats(str(path))
+            self.write_memory(self.profile_dir / f'{name}.memory.txt', peak)
+            self.candidates.append(CandidateProfile(name, seconds, peak, path))
+
+    def add_worker_stats(self, paths):
+        '''Adds the stats pool workers wrote for the current candidate.'''
+        if self.worker_stats is not None:
+            self.worker_stats.extend(paths)
+
+    def write_memory(self, path: Path, peak):
+        statistics = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ]).statistics('lineno')
+        with open(str(path), 'w') as memory_file:
+            memory_file.write(f'Peak traced memory: {peak / (1 << 20):.1f} MiB\n\n')
+            for statistic in statistics[:self.top]:
+                memory_file.write(f'{statistic}\n')
+
+    def summary(self) -> str:
+        '''
+        Returns the slowest candidates and the top functions by cumulative
+        time over all of them.
+        '''
+        if not self.candidates:
+            return 'No candidates were profiled.'
+        lines = ['Slowest candidates:']
+        for candidate in sorted(self.candidates, key=lambda c: c.seconds, reverse=True)[:self.top]:
+            lines.append(f'  {candidate.name:<24} {candidate.seconds:8.1f}s  '
+                         f'peak {candidate.peak_memory / (1 << 20):7.1f} MiB  {candidate.path}')
+        output = io.StringIO()
+        stats = pstats.Stats(str(self.candidates[0].path), stream=output)
+        for candidate in self.candidates[1:]:
+            stats.add(str(candidate.path))
+        stats.sort_stats('cumulative').print_stats(self.top)
+        lines.append(output.getvalue())
+        return '\n'.join(lines)
@@ -0,0 +1,113 @@
+import asyncio
+import fcntl
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+
+# Gazelle allows 10 API calls in any 10 second window. A bucket of 5
+# that refills every 2 seconds never exceeds that, while still letting
+# short bursts through.
+default_rate = 0.5
+default_burst = 5
+
+default_state_path = Path(tempfile.gettempdir()) / f'redactedbetter-{os.getuid()}.ratelimit'
+
+
+class RateLimiter:
+    '''
+    A token bucket whose state lives in a small file, so that every
+    process on the host that talks to the site draws from one budget.
+
+    Callers reserve tokens up front and are told how long to wait before
+    they may use them, which keeps concurrent callers queued in the order
+    they arrived without any polling.
+    '''
+
+    def __init__(self, state_path=None, rate=default_rate, burst=default_burst):
+        self.state_path = Path(state_path) if state_path is not None else default_state_path
+        self.rate = rate
+        self.burst = burst
+        # Counters for this instance, for reporting where the time went.
+        self.requests = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.backoffs = 0
+
+    def _update(self, update):
+        with open(str(self.state_path), 'a+') as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            state_file.seek(0)
+            try:
+                state = json.loads(state_file.read())
+            except ValueError:
+                state = {}
+            now = time.time()
+            # The bucket doesn't refill while a backoff is in force.
+            since = max(state.get('time', now), state.get('blocked_until', 0.0))
+            elapsed = max(0.0, now - since)
+            state['tokens'] = min(self.burst, state.get('tokens', self.burst) + elapsed * self.rate)
+            state['time'] = now
+            result = update(state, now)
+            state_file.seek(0)
+            state_file.truncate()
+            state_file.write(json.dumps(state))
+            return result
+
+    def reserve(self, tokens=1) -> float:
+        '''
+        Takes tokens from the bucket, returning the number of seconds to
+        wait before they may be spent. The bucket may go into debt; later
+        callers then wait for it to be paid off.
+        '''
+        def take(state, now):
+            state['tokens'] -= tokens
+            # The bucket only starts refilling once a backoff ends, so
+            # callers queued behind one go out spaced at the rate after it
+            # rather than all at once.
+            blocked = max(0.0, state.get('blocked_until', 0.0) - now)
+            return blocked + max(0.0, -state['tokens'] / self.rate)
+        self.requests += 1
+        return self._update(take)
+
+    def acquire(self, tokens=1) -> float:
+        '''Blocks until tokens may be spent, returning the time spent waiting.'''
+        delay = self.reserve(tokens)
+        if delay > 0:
+            self.waits += 1
+            self.wait_time += delay
+            time.sleep(delay)
+        return delay
+
+    async def acquire_async(self, tokens=1) -> float:
+        '''
+        Waits without blocking the event loop until tokens may be spent,
+        returning the time spent waiting. Each caller's place is reserved
+        before it waits, so many coroutines waiting at once are let
+        through exactly at the rate.
+        '''
+        delay = self.reserve(tokens)
+        if delay > 0:
+            self.waits += 1
+            self.wait_time += delay
+            await asyncio.sleep(delay)
+        return delay
+
+    def backoff(self, delay: float):
+        '''Holds back every process sharing the bucket for delay seconds.'''
+        def block(state, now):
+            state['blocked_until'] = max(state.get('blocked_until', 0.0), now + delay)
+            # Don't let the pause build up a burst to fire at the server
+            # the moment it ends.
+            state['tokens'] = min(state['tokens'], 0.0)
+        self.backoffs += 1
+        self._update(block)
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'waits': self.waits,
+            'wait_time': self.wait_time,
+            'backoffs': self.backoffs,
+        }
@@ -2,12 +2,18 @@
 import re
 import json
 import time
+import hashlib
+import threading
 import traceback
 from pathlib import Path
 
 import requests
 import html.parser
 
+from red_better.cache import atomic_write
+from red_better.metrics import Metrics
+from red_better.ratelimit import RateLimiter
+
 headers = {
     'Connection': 'keep-alive',
     'Cache-Control': 'max-age=0',
@@ -51,6 +57,19 @@ formats = {
 }
 
 
+# Where the site and its tracker are. Both can be pointed elsewhere,
+# e.g. at a local stand-in (see benchmarks.gazelle).
+default_base_url = 'https://redacted.ch/'
+default_tracker = 'https://flacsfor.me/'
+
+# How long a cached response stays fresh, in seconds, for each action.
+# Responses to actions that aren't listed here are never cached.
+response_ttls = {
+    'torrentgroup': 3 * 24 * 60 * 60,
+    'torrent': 3 * 24 * 60 * 60,
+}
+
+
 def allowed_transcodes(torrent):
     """Some torrent types have transcoding restrictions."""
     preemphasis = re.search(r"""pre[- ]?emphasi(s(ed)?|zed)""", torrent['remasterTitle'], flags=re.IGNORECASE)
@@ -68,6 +87,48 @@ class RequestException(Exception):
     pass
 
 
+class ResponseCache:
+    '''
+    Keeps parsed API responses on disk, one file per action and set of
+    parameters, so that reruns don't have to fetch them again.
+    '''
+
+    def __init__(self, cache_dir: Path, ttls=None):
+        self.cache_dir = Path(cache_dir)
+        self.ttls = response_ttls if ttls is None else ttls
+
+    def _path(self, action, params) -> Path:
+        key = json.dumps({k: str(v) for k, v in params.items()}, sort_keys=True)
+        return self.cache_dir / action / (hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, action, params):
+        '''Returns the cached response, or None if it is missing or stale.'''
+        ttl = self.ttls.get(action)
+        if ttl is None:
+            return None
+        try:
+            with open(str(self._path(action, params)), 'r') as entry_file:
+                entry = json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry['time'] > ttl:
+            return None
+        return entry['response']
+
+    def put(self, action, params, response):
+        if action not in self.ttls:
+            return
+        path = self._path(action, params)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(path, json.dumps({'time': time.time(), 'response': response}))
+
+    def invalidate(self, action, params):
+        try:
+            self._path(action, params).unlink()
+        except FileNotFoundError:
+            pass
+
+
 class RedactedAPI:
     def __init__(
             self,
@@ -76,9 +137,17 @@ class RedactedAPI:
             password=None,
             session_cookie=None,
             api_key=None,
+            response_cache=None,
+            rate_limiter=None,
+            base_url=default_base_url,
+            tracker=default_tracker,
+            metrics=None,
     ):
         self.session = requests.Session()
         self.session.headers.update(headers)
+        # Sessions aren't safe to share between threads, and the prefetcher
+        # makes requests from one of its own.
+        self.session_lock = threading.Lock()
         self.page_size = page_size
         self.username = username
         self.password = password
@@ -88,9 +157,13 @@ class RedactedAPI:
         self.passkey = None
         self.userid = None
         self.api_key_authenticated = False
-        self.tracker = "https://flacsfor.me/"
-        self.last_request = time.time()
-        self.rate_limit = 2.0 # seconds between requests
+        self.base_url = base_url if base_url.endswith('/') else base_url + '/'
+        self.tracker = tracker
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.max_retries = 5
+        self.backoff_base = 5.0 # seconds, doubled on every retry
+        self.response_cache = response_cache
+        self.metrics = metrics if metrics is not None else Metrics()
         self._login()
 
     def _login(self):
@@ -119,7 +192,7 @@ class RedactedAPI:
         self.api_key_authenticated = True
 
     def _login_cookie(self):
-        mainpage = 'https://redacted.ch/';
+        mainpage = self.base_url
         cookiedict = {"session": self.session_cookie}
         cookies = requests.utils.cookiejar_from_dict(cookiedict)
 
@@ -133,7 +206,7 @@ class RedactedAPI:
         if not self.username or self.username == "":
             print("WARNING: username authentication attempted, but username not set, skipping.")
             raise LoginException
-        loginpage = 'https://redacted.ch/login.php'
+        loginpage = self.base_url + 'login.php'
         data = {'username': self.username,
                 'password': self.password}
         r = self.session.post(loginpage, data=data)
@@ -142,29 +215,64 @@ class RedactedAPI:
         self._get_account_info()
 
     def logout(self):
-        self.session.get("https://redacted.ch/logout.php?auth=%s" % self.authkey)
-
-    def request(self, action, passthrough=False, **kwargs):
-        '''Makes an AJAX request at a given action page'''
-        while time.time() - self.last_request < self.rate_limit:
-            time.sleep(0.1)
-
-        ajaxpage = 'https://redacted.ch/ajax.php'
+        with self.session_lock:
+            self.session.get("%slogout.php?auth=%s" % (self.base_url, self.authkey))
+
+    def _get(self, url, tokens=1, **kwargs):
+        '''
+        GETs url once the shared rate limit allows it, backing off and
+        retrying when the site answers with 429 or a server error.
+        '''
+        action = kwargs.get('params', {}).get('action')
+        for attempt in range(self.max_retries + 1):
+            waited = self.rate_limiter.acquire(tokens)
+            if waited > 0:
+                self.metrics.record('api_wait', waited, action=action)
+            with self.metrics.span('api_request', action=action) as span:
+                with self.session_lock:
+                    r = self.session.get(url, allow_redirects=False, **kwargs)
+                span['status'] = r.status_code
+                span['bytes_read'] = len(r.content)
+            if r.status_code != 429 and r.status_code < 500:
+                break
+            delay = retry_after(r) or self.backoff_base * 2 ** attempt
+            print(f'HTTP {r.status_code} from {url}, backing off for {delay:.0f}s')
+            self.rate_limiter.backoff(delay)
+        return r
+
+    def request(self, action, passthrough=False, refresh=False, **kwargs):
+        '''
+        Makes an AJAX request at a given action page. Fresh responses from
+        the response cache are used instead, unless refresh is set.
+        '''
+        use_cache = self.response_cache is not None and not passthrough
+        if use_cache and not refresh:
+            cached = self.response_cache.get(action, kwargs)
+            if cached is not None:
+                return cached
+
+        ajaxpage = self.base_url + 'ajax.php'
         params = {'action': action}
         if not self.api_key_authenticated and self.authkey:
             params['auth'] = self.authkey
         params.update(kwargs)
-        r = self.session.get(ajaxpage, params=params, allow_redirects=False)
-        self.last_request = time.time()
+        r = self._get(ajaxpage, params=params)
         if passthrough:
             return r.content
         try:
             parsed = json.loads(r.content)
             if parsed['status'] != 'success':
                 return None
-            return parsed['response']
         except ValueError as e:
             raise RequestException(e)
+        if use_cache:
+            self.response_cache.put(action, kwargs, parsed['response'])
+        return parsed['response']
+
+    def invalidate(self, action, **kwargs):
+        '''Drops the cached response to a request, if there is one.'''
+        if self.response_cache is not None:
+            self.response_cache.invalidate(action, kwargs)
 
     def get_artist(self, id=None, format='MP3', best_seeded=True):
         res = self.request('artist', id=id)
@@ -196,32 +304,33 @@ class RedactedAPI:
         with open(str(file_path), 'wb') as file:
             file.write(torrent_file)
 
+    def snatched_page(self, page):
+        '''Returns (groupid, torrentid) for one page of snatched torrents, newest first.'''
+        response = self.request(
+            'user_torrents',
+            id=self.userid,
+            type='snatched',
+            limit=self.page_size,
+            offset=page * self.page_size
+        )
+        return [(int(entry['groupId']), int(entry['torrentId'])) for entry in response['snatched']]
+
     def snatched(self):
         page = 0
         while True:
-            response = self.request(
-                'user_torrents',
-                id=self.userid,
-                type='snatched',
-                limit=self.page_size,
-                offset=page * self.page_size
-            )
-            snatched = response['snatched']
+            snatched = self.snatched_page(page)
             if len(snatched) == 0:
                 break
             print(f'Fetched snatched results {page * self.page_size} to '
                   f'{(page + 1) * self.page_size - 1}')
-            for entry in snatched:
-                group_id = int(entry['groupId'])
-                torrent_id = int(entry['torrentId'])
-                yield group_id, torrent_id
+            yield from snatched
             page += 1
 
     def release_url(self, group, torrent):
-        return "https://redacted.ch/torrents.php?id=%s&torrentid=%s#torrent%s" % (group['group']['id'], torrent['id'], torrent['id'])
+        return "%storrents.php?id=%s&torrentid=%s#torrent%s" % (self.base_url, group['group']['id'], torrent['id'], torrent['id'])
 
     def permalink(self, torrent):
-        return "https://redacted.ch/torrents.php?torrentid=%s" % torrent['id']
+        return "%storrents.php?torrentid=%s" % (self.base_url, torrent['id'])
 
     def get_better(self, search_type=3, tags=None):
         if tags is None:
@@ -238,17 +347,14 @@ class RedactedAPI:
 
     def get_torrent(self, torrent_id):
         '''Downloads the torrent at torrent_id using the authkey and passkey'''
-        while time.time() - self.last_request < self.rate_limit:
-            time.sleep(0.1)
-
-        torrentpage = 'https://redacted.ch/torrents.php'
+        torrentpage = self.base_url + 'torrents.php'
         params = {'action': 'download', 'id': torrent_id}
         if self.authkey:
             params['authkey'] = self.authkey
             params['torrent_pass'] = self.passkey
-        r = self.session.get(torrentpage, params=params, allow_redirects=False)
+        # Downloads are charged double, as they always have been.
+        r = self._get(torrentpage, tokens=2, params=params)
 
-        self.last_request = time.time() + 2.0
         if r.status_code == 200 and 'application/x-bittorrent' in r.headers['content-type']:
             return r.content
         return None
@@ -257,5 +363,26 @@ class RedactedAPI:
         return self.request('torrent', id=id)['torrent']
 
 
+def retry_after(response):
+    '''Returns the delay in seconds asked for by a Retry-After header, if any.'''
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
 def unescape(text):
     return html.unescape(text)
+
+
+def file_list(torrent):
+    '''
+    Returns the (relpath, size) of every file in a torrent, from its
+    fileList ("name{{{size}}}|||name{{{size}}}...").
+    '''
+    files = []
+    for item in unescape(torrent['fileList']).split('|||'):
+        match = re.match(r'(.*)\{\{\{(\d+)\}\}\}$', item, flags=re.DOTALL)
+        if match:
+            files.append((match.group(1), int(match.group(2))))
+    return files
@@ -0,0 +1,67 @@
+import time
+from pathlib import Path
+
+from red_better.cache import JournaledStore
+
+
+class SnatchedIndex(JournaledStore):
+    '''
+    The group and torrent IDs of every snatched torrent, keyed by torrent
+    ID, with the time each was first seen. A marker file next to the
+    index records that a sync has reached the end of the snatched list
+    once, after which syncing stops at the first page that holds a
+    torrent it already knows.
+    '''
+
+    def __init__(self, path: Path):
+        super().__init__(path, key_type=int)
+        self.complete_marker = self.path.with_name(self.path.name + '.complete')
+
+    @property
+    def complete(self) -> bool:
+        return self.complete_marker.exists()
+
+    def sync(self, api) -> int:
+        '''
+        Adds the torrents snatched since the last sync, newest first, and
+        returns how many were new. A sync that was interrupted before
+        reaching the end of the list carries on from where it stopped.
+        '''
+        complete = self.complete
+        added = 0
+        page = 0
+        while True:
+            snatched = api.snatched_page(page)
+            if not snatched:
+                self.complete_marker.touch()
+                break
+            print(f'Fetched snatched results {page * api.page_size} to '
+                  f'{page * api.page_size + len(snatched) - 1}')
+            seen = time.time()
+            known = 0
+            for group_id, torrent_id in snatched:
+                if torrent_id in self:
+                    known += 1
+                else:
+                    self.set(torrent_id, {'group': group_id, 'seen': seen})
+                    added += 1
+            if known:
+                if complete:
+                    break
+                # Everything up to the end of the last sync is known now,
+                # so skip the pages it already fetched.
+                page = max(page + 1, len(self) // api.page_size)
+            else:
+                page += 1
+        return added
+
+    def candidates(self, statuses, retry_modes):
+        '''
+        Yields (groupid, torrentid) for every torrent without a status in
+        statuses (a Cache's ids), or whose status is one of retry_modes,
+        newest torrents first.
+        '''
+        for torrent_id, entry in sorted(self.items(), reverse=True):
+            status = statuses.get(torrent_id)
+            if status is None or status in retry_modes:
+                yield entry['group'], torrent_id
@@ -1,26 +1,82 @@
-import shutil
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import List, Optional
 
-from red_better.command import run_command
+from red_better.manifest import ReleaseManifest
+from red_better.probe import ReleaseProbe
+
+full_spectrogram_options = ['remix', '1', 'spectrogram', '-x', '3000', '-y', '513', '-z', '120', '-w', 'Kaiser']
+zoom_spectrogram_options = ['remix', '1', 'spectrogram', '-x', '500', '-y', '1025', '-z', '120', '-w', 'Kaiser']
+
+# Zoomed spectrograms cover zoom_length seconds starting a zoom_start'th
+# of the way into the track.
+zoom_start = 3
+zoom_length = 2
+
+# SoX leaves out titles too wide for the image, so longer ones are cut
+# down to this many characters, counting from the end.
+zoom_title_length_limit = 85
+
+
+def spectrogram_commands(flac_file: str, title: str, info, output_stem: Path) -> List[List[str]]:
+    '''Returns the sox commands that make the full and zoomed spectrograms of a FLAC.'''
+    caption = f'         {info.bits_per_sample} bit  |  {info.sample_rate} Hz'
+    start = int(info.length) // zoom_start
+    zoom_title = title
+    if len(zoom_title) > zoom_title_length_limit:
+        zoom_title = '... ' + zoom_title[-zoom_title_length_limit:]
+    return [
+        ['sox', flac_file, '-n'] + full_spectrogram_options + [
+            '-t', title,
+            '-c', f'{caption}  |  {int(info.length)} sec',
+            '-o', f'{output_stem}-full.png'],
+        ['sox', flac_file, '-n'] + zoom_spectrogram_options + [
+            '-S', str(start), '-d', str(zoom_length),
+            '-t', zoom_title,
+            '-c', f'{caption}  |  {zoom_length} sec  |  starting @ {start} sec',
+            '-o', f'{output_stem}-zoom.png'],
+    ]
+
+
+def run_sox(command: List[str]) -> Optional[str]:
+    '''Runs a sox command, returning its error output if it fails.'''
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        return result.stderr.decode('utf-8', errors='replace').strip()
+    return None
 
 
 def make_spectrograms(
         flac_dir: Path,
         spectrogram_dir: Path,
-        threads: int
+        threads: int,
+        manifest: Optional[ReleaseManifest] = None,
+        probe: Optional[ReleaseProbe] = None
 ) -> bool:
-    command = f'bash {Path(__file__).parent}/run_sox.sh --threads {threads} .'
-    temp_spectrogram_dir = flac_dir / 'Spectrograms'
-    if temp_spectrogram_dir.exists():
-        print(f'Temp spectrogram dir {temp_spectrogram_dir} already exists.'
-              f'Skipping since unable to validate.')
-        return False
-    if run_command(command, flac_dir) is None:
-        return False
-    if not temp_spectrogram_dir.exists():
-        print(f'Temp spectrogram dir {temp_spectrogram_dir} was not created'
-              f'for some reason. Skipping.')
+    '''
+    Writes a full and a zoomed spectrogram of every FLAC in flac_dir into
+    spectrogram_dir, running up to threads sox processes at once. FLACs
+    in subdirectories are named after their path, e.g. "CD1 - 01".
+    '''
+    if manifest is None:
+        manifest = ReleaseManifest(flac_dir)
+    if probe is None:
+        probe = ReleaseProbe(manifest.paths('.flac'))
+    flacs = manifest.files('.flac')
+    if not flacs:
+        print(f'No FLACs found in {flac_dir}. Skipping.')
         return False
-    shutil.copytree(str(temp_spectrogram_dir), str(spectrogram_dir), dirs_exist_ok=True)
-    shutil.rmtree(temp_spectrogram_dir)
-    return True
+
+    commands = []
+    for entry in flacs:
+        stem = os.path.splitext(entry.relpath)[0].replace(os.sep, ' - ')
+        commands.extend(spectrogram_commands(entry.path, f'{Path(flac_dir).name}/{entry.relpath}',
+                                             probe[entry.path], Path(spectrogram_dir) / stem))
+
+    with ThreadPoolExecutor(max(threads, 1)) as executor:
+        errors = [error for error in executor.map(run_sox, commands) if error is not None]
+    for error in errors:
+        print(f'Failed to make a spectrogram: {error}')
+    return not errors
@@ -0,0 +1,72 @@
+'''
+A staging area for transcodes, such as /dev/shm or a local SSD. Releases
+are encoded, tagged and hashed there, away from the disks being seeded
+from, and only moved into output_dir once they are finished, so a
+failed transcode never leaves a half-written directory behind.
+'''
+import errno
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+
+class Staging:
+    '''
+    A directory of its own under root for this run, holding at most size
+    bytes of transcodes at a time. Releases that don't fit are left to
+    be written straight into output_dir.
+    '''
+
+    def __init__(self, root: Path, size: int):
+        Path(root).mkdir(parents=True, exist_ok=True)
+        self.dir = tempfile.mkdtemp(prefix='redactedbetter-', dir=str(root))
+        self.size = size
+        self.reserved = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, nbytes) -> bool:
+        '''Sets aside nbytes for a release, if they fit.'''
+        with self.lock:
+            if self.reserved + nbytes > self.size or nbytes > shutil.disk_usage(self.dir).free:
+                return False
+            self.reserved += nbytes
+            return True
+
+    def release(self, nbytes):
+        with self.lock:
+            self.reserved = max(self.reserved - nbytes, 0)
+
+    def path(self, final_dir) -> str:
+        '''Returns where final_dir is written until it is published.'''
+        return os.path.join(self.dir, os.path.basename(final_dir))
+
+    def publish(self, staged_dir, final_dir):
+        '''
+        Moves a finished directory to final_dir with a single rename. On
+        another filesystem it is copied next to final_dir in one pass
+        and then renamed into place.
+        '''
+        if os.path.exists(final_dir):
+            raise FileExistsError(errno.EEXIST, 'transcode output directory already exists', final_dir)
+        os.makedirs(os.path.dirname(final_dir), exist_ok=True)
+        try:
+            os.rename(staged_dir, final_dir)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+        partial = final_dir + '.partial'
+        # Left over from an interrupted copy of this same release.
+        shutil.rmtree(partial, ignore_errors=True)
+        try:
+            shutil.copytree(staged_dir, partial)
+            os.rename(partial, final_dir)
+        except BaseException:
+            shutil.rmtree(partial, ignore_errors=True)
+            raise
+        shutil.rmtree(staged_dir, ignore_errors=True)
+
+    def close(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
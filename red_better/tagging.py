@@ -27,8 +27,11 @@
 
 import os.path
 import re
+import shlex
+from concurrent.futures import ThreadPoolExecutor
 import mutagen
 import mutagen.flac
+import mutagen.id3
 import mutagen.mp3
 from mutagen.easyid3 import EasyID3
 
@@ -74,6 +77,30 @@ def scrub_tag(name, value):
 
     return scrubbed_value
 
+def read_tags(filename):
+    """Return the tags of a file as a dict of lists of values."""
+    info = mutagen.File(filename, easy=True)
+    return {tag: list(info[tag]) for tag in info.keys()}
+
+def tag_problems(filename, tags, check_tracknumber_format=True):
+    """Return every way in which a file's tags (as returned by
+    read_tags) fall short of the required redacted.ch tags.
+
+    """
+    problems = []
+    for tag in ['artist', 'album', 'title', 'tracknumber']:
+        if tag not in tags:
+            problems.append('"%s" has no %s tag' % (filename, tag))
+        elif tags[tag] == ['']:
+            problems.append('"%s" has an empty %s tag' % (filename, tag))
+
+    if check_tracknumber_format and tags.get('tracknumber', [''])[0]:
+        tracknumber = tags['tracknumber'][0]
+        if not valid_fractional_tag(tracknumber):
+            problems.append('"%s" has a malformed tracknumber tag ("%s")' % (filename, tracknumber))
+
+    return problems
+
 def check_tags(filename, check_tracknumber_format=True):
     """Verify that the file has the required redacted.ch tags.
 
@@ -81,42 +108,55 @@ def check_tags(filename, check_tracknumber_format=True):
     invalid.
 
     """
-    info = mutagen.File(filename, easy=True)
-    for tag in ['artist', 'album', 'title', 'tracknumber']:
-        if tag not in list(info.keys()):
-            return (False, '"%s" has no %s tag' % (filename, tag))
-        elif info[tag] == ['']:
-            return (False, '"%s" has an empty %s tag' % (filename, tag))
+    problems = tag_problems(filename, read_tags(filename), check_tracknumber_format)
+    if problems:
+        return (False, problems[0])
+    return (True, None)
 
-    if check_tracknumber_format:
-        tracknumber = info['tracknumber'][0]
-        if not valid_fractional_tag(tracknumber):
-            return (False, '"%s" has a malformed tracknumber tag ("%s")' % (filename, tracknumber))
+def check_release_tags(filenames, threads, check_tracknumber_format=True):
+    """Read and verify the tags of every file of a release at once.
 
-    return (True, None)
+    Returns the problems found in all of them (an empty list if they
+    are all OK) and the tags of each file, keyed by filename, so they
+    needn't be read again.
 
-def copy_tags(flac_file, transcode_file):
-    flac_info = mutagen.flac.FLAC(flac_file)
-    transcode_info = None
-    valid_key_fn = None
-    transcode_ext = os.path.splitext(transcode_file)[1].lower()
+    """
+    def check(filename):
+        try:
+            tags = read_tags(filename)
+        except Exception as e:
+            return ['"%s" could not be read: %s' % (filename, e)], None
+        return tag_problems(filename, tags, check_tracknumber_format), tags
+
+    with ThreadPoolExecutor(max(threads, 1)) as executor:
+        results = list(executor.map(check, filenames))
+    problems = [problem for file_problems, _ in results for problem in file_problems]
+    tag_sets = {filename: tags for filename, (_, tags) in zip(filenames, results) if tags is not None}
+    return problems, tag_sets
+
+def transcode_tags(flac_tags, transcode_ext):
+    """Return the tags a transcode with extension transcode_ext (e.g.
+    '.mp3') should be given, built from flac_tags as returned by
+    read_tags. The result is a dict of lists of values, keyed by
+    Vorbis comment name for FLAC and by EasyID3 key for MP3, so it can
+    be checked with tag_problems before anything is written.
 
+    """
     if transcode_ext == '.flac':
-        transcode_info = mutagen.flac.FLAC(transcode_file)
         valid_key_fn = lambda k: True
 
     elif transcode_ext == '.mp3':
-        transcode_info = mutagen.mp3.EasyMP3(transcode_file)
-        valid_key_fn = lambda k: k in list(EasyID3.valid_keys.keys())
+        valid_key_fn = lambda k: k in EasyID3.valid_keys
 
     else:
-        raise TaggingException('Unsupported tag format "%s"' % transcode_file)
+        raise TaggingException('Unsupported tag format "%s"' % transcode_ext)
 
-    for tag in filter(valid_key_fn, flac_info):
+    tags = {}
+    for tag in filter(valid_key_fn, flac_tags):
         # scrub the FLAC tags, just to be on the safe side.
-        values = [scrub_tag(tag,v) for v in flac_info[tag]]
+        values = [scrub_tag(tag,v) for v in flac_tags[tag]]
         if values and values != ['']:
-            transcode_info[tag] = values
+            tags[tag] = values
 
     if transcode_ext == '.mp3':
         # Support for TRCK and TPOS x/y notation, which is not
@@ -129,27 +169,104 @@ def copy_tags(flac_file, transcode_file):
         # as 'tracktotal' and 'disctotal'. We support either tag, but
         # in files with both we choose only one.
 
-        if 'tracknumber' in list(transcode_info.keys()):
+        if 'tracknumber' in tags:
             totaltracks = None
-            if 'totaltracks' in list(flac_info.keys()):
-                totaltracks = scrub_tag('totaltracks', flac_info['totaltracks'][0])
-            elif 'tracktotal' in list(flac_info.keys()):
-                totaltracks = scrub_tag('tracktotal', flac_info['tracktotal'][0])
+            if 'totaltracks' in flac_tags:
+                totaltracks = scrub_tag('totaltracks', flac_tags['totaltracks'][0])
+            elif 'tracktotal' in flac_tags:
+                totaltracks = scrub_tag('tracktotal', flac_tags['tracktotal'][0])
 
             if totaltracks:
-                transcode_info['tracknumber'] = ['%s/%s' % (transcode_info['tracknumber'][0], totaltracks)]
+                tags['tracknumber'] = ['%s/%s' % (tags['tracknumber'][0], totaltracks)]
 
-        if 'discnumber' in list(transcode_info.keys()):
+        if 'discnumber' in tags:
             totaldiscs = None
-            if 'totaldiscs' in list(flac_info.keys()):
-                totaldiscs = scrub_tag('totaldiscs', flac_info['totaldiscs'][0])
-            elif 'disctotal' in list(flac_info.keys()):
-                totaldiscs = scrub_tag('disctotal', flac_info['disctotal'][0])
+            if 'totaldiscs' in flac_tags:
+                totaldiscs = scrub_tag('totaldiscs', flac_tags['totaldiscs'][0])
+            elif 'disctotal' in flac_tags:
+                totaldiscs = scrub_tag('disctotal', flac_tags['disctotal'][0])
 
             if totaldiscs:
-                transcode_info['discnumber'] = ['%s/%s' % (transcode_info['discnumber'][0], totaldiscs)]
+                tags['discnumber'] = ['%s/%s' % (tags['discnumber'][0], totaldiscs)]
+
+    return tags
+
+def id3_tags(tags):
+    """Build the ID3 frames for a set of MP3 tags (as returned by
+    transcode_tags) in memory.
+
+    """
+    id3 = mutagen.id3.ID3()
+    for key, values in tags.items():
+        EasyID3.Set[key](id3, key, values)
+    return id3
+
+# Text frames lame writes itself with --tv when given a single value.
+# Anything else (comments, multiple values) is left to write_tags.
+lame_text_frames = set([
+        'TALB', 'TBPM', 'TCOM', 'TCON', 'TCOP', 'TDOR', 'TDRC', 'TENC',
+        'TEXT', 'TIT1', 'TIT2', 'TIT3', 'TKEY', 'TLAN', 'TMED', 'TOAL',
+        'TOPE', 'TPE1', 'TPE2', 'TPE3', 'TPE4', 'TPOS', 'TPUB', 'TRCK',
+        'TSO2', 'TSOA', 'TSOP', 'TSOT', 'TSRC', 'TSSE', 'TXXX',
+        ])
+
+def encoder_tag_args(encoder, tags):
+    """Return the command line options with which encoder ('flac' or
+    'lame') writes tags (as returned by transcode_tags) into the file it
+    produces, or None if it can't write all of them itself.
+
+    """
+    if encoder == 'flac':
+        args = []
+        for tag, values in tags.items():
+            for value in values:
+                args += ['-T', '%s=%s' % (tag, value)]
+
+    elif encoder == 'lame':
+        args = ['--id3v2-only', '--id3v2-utf16']
+        for frame in id3_tags(tags).values():
+            if frame.FrameID not in lame_text_frames or len(frame.text) != 1:
+                return None
+            if frame.FrameID == 'TXXX':
+                args += ['--tv', 'TXXX=%s=%s' % (frame.desc, frame.text[0])]
+            else:
+                args += ['--tv', '%s=%s' % (frame.FrameID, frame.text[0])]
+
+    else:
+        return None
+
+    return ' '.join(shlex.quote(arg) for arg in args)
+
+def write_tags(transcode_file, tags):
+    """Replace the tags of transcode_file with tags (as returned by
+    transcode_tags) in a single write.
 
-    transcode_info.save()
+    """
+    transcode_ext = os.path.splitext(transcode_file)[1].lower()
+    if transcode_ext == '.flac':
+        transcode_info = mutagen.flac.FLAC(transcode_file)
+        if transcode_info.tags is not None:
+            transcode_info.tags.clear()
+        for tag, values in tags.items():
+            transcode_info[tag] = values
+        transcode_info.save()
+
+    elif transcode_ext == '.mp3':
+        id3_tags(tags).save(transcode_file)
+
+    else:
+        raise TaggingException('Unsupported tag format "%s"' % transcode_file)
+
+def copy_tags(flac_file, transcode_file, flac_tags=None):
+    """Copy the tags of flac_file to transcode_file. flac_tags are the
+    tags of flac_file as returned by read_tags, if they have already
+    been read.
+
+    """
+    if flac_tags is None:
+        flac_tags = read_tags(flac_file)
+    transcode_ext = os.path.splitext(transcode_file)[1].lower()
+    write_tags(transcode_file, transcode_tags(flac_tags, transcode_ext))
 
 # EasyID3 extensions for redactedbetter.
 
@@ -162,7 +279,7 @@ for key, frameid in {
     EasyID3.RegisterTextKey(key, frameid)
 
 def comment_get(id3, _):
-    return [comment.text for comment in id3['COMM'].text]
+    return [text for comment in id3.getall('COMM') for text in comment.text]
 
 def comment_set(id3, _, value):
     id3.add(mutagen.id3.COMM(encoding=3, lang='eng', desc='', text=value))
@@ -0,0 +1,289 @@
+import hashlib
+import mmap
+import os
+import threading
+import time
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from red_better.manifest import ReleaseManifest
+
+SOURCE = 'RED'
+CREATED_BY = 'REDBetter'
+HASH_THREADS = 4
+# Pieces hashed by each task handed to a hashing thread.
+PIECES_PER_TASK = 16
+
+
+class BencodeError(ValueError):
+    pass
+
+
+def bencode(value) -> bytes:
+    out = []
+    _bencode(value, out)
+    return b''.join(out)
+
+
+def _bencode(value, out):
+    if isinstance(value, int):
+        out.append(b'i%de' % value)
+    elif isinstance(value, (str, bytes)):
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        out.append(b'%d:' % len(value))
+        out.append(value)
+    elif isinstance(value, (list, tuple)):
+        out.append(b'l')
+        for item in value:
+            _bencode(item, out)
+        out.append(b'e')
+    elif isinstance(value, dict):
+        out.append(b'd')
+        items = [(key.encode('utf-8') if isinstance(key, str) else key, item) for key, item in value.items()]
+        for key, item in sorted(items):
+            _bencode(key, out)
+            _bencode(item, out)
+        out.append(b'e')
+    else:
+        raise BencodeError(f'Cannot bencode {type(value).__name__}')
+
+
+def bdecode(data: bytes):
+    '''Decodes bencoded data. Strings and dict keys are returned as bytes.'''
+    try:
+        value, end = _bdecode(data, 0)
+    except (IndexError, ValueError) as e:
+        raise BencodeError(f'Invalid bencoded data: {e}')
+    if end != len(data):
+        raise BencodeError('Invalid bencoded data: trailing bytes')
+    return value
+
+
+def _bdecode(data, i):
+    c = data[i:i + 1]
+    if c == b'i':
+        end = data.index(b'e', i)
+        return int(data[i + 1:end]), end + 1
+    if c == b'l':
+        i += 1
+        items = []
+        while data[i:i + 1] != b'e':
+            item, i = _bdecode(data, i)
+            items.append(item)
+        return items, i + 1
+    if c == b'd':
+        i += 1
+        items = {}
+        while data[i:i + 1] != b'e':
+            key, i = _bdecode(data, i)
+            items[key], i = _bdecode(data, i)
+        return items, i + 1
+    if c.isdigit():
+        colon = data.index(b':', i)
+        start = colon + 1
+        end = start + int(data[i:colon])
+        if end > len(data):
+            raise BencodeError('Invalid bencoded data: truncated string')
+        return data[start:end], end
+    raise BencodeError(f'Invalid bencoded data at byte {i}')
+
+
+def announce_url(tracker, passkey) -> str:
+    return '%(tracker)s%(passkey)s/announce' % {
+        'tracker' : tracker,
+        'passkey' : passkey,
+    }
+
+
+class FileMaps:
+    '''Memory maps of the files a hashing task reads, opened as needed.'''
+
+    def __init__(self):
+        self.maps = {}
+
+    def view(self, path) -> memoryview:
+        if path not in self.maps:
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[path] = (mapped, memoryview(mapped))
+        return self.maps[path][1]
+
+    def close(self):
+        for mapped, view in self.maps.values():
+            view.release()
+            mapped.close()
+        self.maps = {}
+
+
+def file_starts(files):
+    starts = []
+    offset = 0
+    for _, size in files:
+        starts.append(offset)
+        offset += size
+    return starts
+
+
+def hash_pieces(files, starts, piece_length, total, first, count):
+    '''
+    Returns the SHA-1 digests of count pieces from piece first of the
+    concatenation of files, a list of (path, size) pairs starting at the
+    offsets in starts and ending at total.
+    '''
+    maps = FileMaps()
+    try:
+        digests = []
+        for piece in range(first, first + count):
+            start = piece * piece_length
+            end = min(start + piece_length, total)
+            digest = hashlib.sha1()
+            index = bisect_right(starts, start) - 1
+            position = start
+            while position < end:
+                path, size = files[index]
+                file_end = starts[index] + size
+                if position >= file_end:
+                    index += 1
+                    continue
+                offset = position - starts[index]
+                length = min(end, file_end) - position
+                digest.update(maps.view(path)[offset:offset + length])
+                position += length
+            digests.append(digest.digest())
+        return digests
+    finally:
+        maps.close()
+
+
+def submit_pieces(executor, files, piece_length, first, last, total):
+    '''Queues the hashing of pieces first to last on executor, returning the futures in order.'''
+    starts = file_starts(files)
+    return [executor.submit(hash_pieces, files, starts, piece_length, total,
+                            piece, min(PIECES_PER_TASK, last - piece))
+            for piece in range(first, last, PIECES_PER_TASK)]
+
+
+def metainfo(name, files, pieces, announce, piece_length) -> bytes:
+    '''
+    Returns a bencoded .torrent of a directory named name holding files,
+    a list of (relpath, size) pairs, made the way mktorrent -p -s RED
+    makes it.
+    '''
+    return bencode({
+        'announce': announce,
+        'created by': CREATED_BY,
+        'creation date': int(time.time()),
+        'info': {
+            'files': [{'length': size, 'path': relpath.split(os.sep)} for relpath, size in files],
+            'name': name,
+            'piece length': piece_length,
+            'pieces': pieces,
+            'private': 1,
+            'source': SOURCE,
+        },
+    })
+
+
+def make_torrent(input_dir, announce, piece_length, manifest=None, executor=None) -> bytes:
+    '''
+    Returns a bencoded .torrent of input_dir. piece_length is the log2
+    of the piece size, as given to mktorrent -l.
+    '''
+    if manifest is None:
+        manifest = ReleaseManifest(input_dir)
+    piece_length = 1 << int(piece_length)
+    files = [(entry.path, entry.size) for entry in manifest.entries]
+    total = sum(size for _, size in files)
+    pieces = -(-total // piece_length)
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(HASH_THREADS)
+    try:
+        futures = submit_pieces(executor, files, piece_length, 0, pieces, total)
+        digests = b''.join(digest for future in futures for digest in future.result())
+    finally:
+        if own_executor:
+            executor.shutdown()
+    return metainfo(os.path.basename(manifest.root),
+                    [(entry.relpath, entry.size) for entry in manifest.entries],
+                    digests, announce, piece_length)
+
+
+class TorrentStream:
+    '''
+    Builds the .torrent of a directory while its files are still being
+    written. Every file it will hold is named up front; as each is
+    added, the pieces now covered by finished files (in torrent order)
+    are queued on executor, so little is left to hash once the last file
+    is done.
+    '''
+
+    def __init__(self, root, relpaths, announce, piece_length, executor):
+        self.root = os.path.abspath(root)
+        self.relpaths = sorted(relpaths)
+        self.announce = announce
+        self.piece_length = 1 << int(piece_length)
+        self.executor = executor
+        self.sizes = {}
+        self.ready = 0
+        self.next_file = 0
+        self.next_piece = 0
+        self.futures = []
+        self.failed = False
+        self.lock = threading.Lock()
+
+    def add(self, path):
+        '''Marks a file as finished. Safe to call from any thread.'''
+        with self.lock:
+            try:
+                self.sizes[os.path.relpath(path, self.root)] = os.path.getsize(path)
+                self._advance(final=False)
+            except Exception:
+                # Leave the torrent to be built from scratch.
+                self.failed = True
+
+    def _advance(self, final):
+        while self.next_file < len(self.relpaths) and self.relpaths[self.next_file] in self.sizes:
+            self.ready += self.sizes[self.relpaths[self.next_file]]
+            self.next_file += 1
+        last = -(-self.ready // self.piece_length) if final else self.ready // self.piece_length
+        if last > self.next_piece:
+            files = [(os.path.join(self.root, relpath), self.sizes[relpath])
+                     for relpath in self.relpaths[:self.next_file]]
+            self.futures.extend(submit_pieces(self.executor, files, self.piece_length,
+                                              self.next_piece, last, self.ready))
+            self.next_piece = last
+
+    def settle(self, root):
+        '''
+        Hashes what is left now, while the files are still where they
+        were written, so that the directory can then be moved to root.
+        '''
+        with self.lock:
+            self._advance(final=True)
+        wait(self.futures)
+        self.root = os.path.abspath(root)
+
+    def finish(self, manifest=None):
+        '''
+        Returns the bencoded .torrent, or None if the directory doesn't
+        hold exactly the files that were expected (or hashing failed), in
+        which case it should be built from scratch.
+        '''
+        if manifest is None:
+            manifest = ReleaseManifest(self.root)
+        with self.lock:
+            if self.failed or self.relpaths != [entry.relpath for entry in manifest.entries]:
+                return None
+            if any(self.sizes.get(entry.relpath) != entry.size for entry in manifest.entries):
+                return None
+            self._advance(final=True)
+        try:
+            digests = b''.join(digest for future in self.futures for digest in future.result())
+        except OSError:
+            return None
+        return metainfo(os.path.basename(self.root),
+                        [(relpath, self.sizes[relpath]) for relpath in self.relpaths],
+                        digests, self.announce, self.piece_length)
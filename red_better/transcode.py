@@ -9,11 +9,15 @@ import shutil
 import signal
 import subprocess
 import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 import unidecode
 import html
-import mutagen.flac
 
-from red_better import tagging
+from red_better import profiling, tagging, torrent
+from red_better.manifest import ReleaseManifest
+from red_better.probe import ReleaseProbe, read_streaminfo
 
 encoders = {
     '320':  {'enc': 'lame', 'ext': '.mp3',  'opts': '-h -b 320 --ignore-tag-errors'},
@@ -22,6 +26,16 @@ encoders = {
     'FLAC': {'enc': 'flac', 'ext': '.flac', 'opts': '--best'}
 }
 
+# Written into the transcode directories of a release whose transcode
+# has failed, so that workers skip the rest of its files.
+ABORT_MARKER = '.transcode-aborted'
+
+# Files of the source release copied alongside the transcodes.
+extra_extensions = ['.cue', '.gif', '.jpeg', '.jpg', '.log', '.md5', '.nfo', '.pdf', '.png', '.sfv', '.txt']
+
+# Bits per second of the largest MP3s, for how much room a transcode needs.
+mp3_bitrate = 320000
+
 class TranscodeException(Exception):
     pass
 
@@ -31,6 +45,21 @@ class TranscodeDownmixException(TranscodeException):
 class UnknownSampleRateException(TranscodeException):
     pass
 
+class PathTooLongException(TranscodeException):
+    pass
+
+class PartialTranscodeException(TranscodeException):
+    '''
+    Some of the formats of a file failed. transcode_files holds the
+    files of the others (None for the failed ones), and failures what
+    went wrong with each failed format, by its position in the outputs.
+    '''
+
+    def __init__(self, transcode_files, failures):
+        super().__init__('; '.join(failures.values()))
+        self.transcode_files = transcode_files
+        self.failures = failures
+
 # In most Unix shells, pipelines only report the return code of the
 # last process. We need to know if any process in the transcode
 # pipeline fails, not just the last one.
@@ -71,6 +100,57 @@ def run_pipeline(cmds):
     results.append((last_proc.returncode, last_stderr))
     return results
 
+# Like run_pipeline, but the output of one decoder is copied to several
+# encoders at once, so a file that is needed in several formats is only
+# decoded (or resampled) once. Results are returned as (code, stderr)
+# pairs for the decoder followed by each encoder.
+#
+# The encoders' stderr goes to temporary files rather than pipes: an
+# encoder blocked on a full stderr pipe would stop reading its input,
+# and with it the whole tee.
+def run_tee_pipeline(decoder, encoder_cmds):
+    stderrs = [tempfile.TemporaryFile() for _ in range(len(encoder_cmds) + 1)]
+    sigpipe_handler = signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    encoder_procs = []
+    try:
+        decoder_proc = subprocess.Popen(shlex.split(decoder), stdout=subprocess.PIPE, stderr=stderrs[0])
+        for cmd, stderr in zip(encoder_cmds, stderrs[1:]):
+            encoder_procs.append(subprocess.Popen(shlex.split(cmd), stdin=subprocess.PIPE, bufsize=0,
+                                                  stdout=subprocess.DEVNULL, stderr=stderr))
+    finally:
+        signal.signal(signal.SIGPIPE, sigpipe_handler)
+
+    try:
+        live = list(encoder_procs)
+        while live:
+            chunk = decoder_proc.stdout.read(1 << 16)
+            if not chunk:
+                break
+            for proc in list(live):
+                try:
+                    proc.stdin.write(chunk)
+                except BrokenPipeError:
+                    # This encoder died; its exit code says why. Keep
+                    # feeding the others.
+                    live.remove(proc)
+        # If every encoder died, this gives the decoder its SIGPIPE.
+        decoder_proc.stdout.close()
+        for proc in encoder_procs:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+        results = []
+        for proc, stderr in zip([decoder_proc] + encoder_procs, stderrs):
+            proc.wait()
+            stderr.seek(0)
+            results.append((proc.returncode, stderr.read()))
+        return results
+    finally:
+        for stderr in stderrs:
+            stderr.close()
+
 def locate(root, match_function, ignore_dotfiles=True):
     '''
     Yields all filenames within the root directory for which match_function returns True.
@@ -88,20 +168,27 @@ def ext_matcher(*extensions):
     '''
     return lambda f: os.path.splitext(f)[-1].lower() in extensions
 
+def probe_release(flac_dir, manifest=None):
+    '''
+    Returns a ReleaseProbe of every FLAC within flac_dir. manifest is the
+    release's ReleaseManifest, if it has already been made.
+    '''
+    if manifest is None:
+        manifest = ReleaseManifest(flac_dir)
+    return ReleaseProbe(manifest.paths('.flac'))
+
 def is_24bit(flac_dir):
     '''
     Returns True if any FLAC within flac_dir is 24 bit.
     '''
-    flacs = (mutagen.flac.FLAC(flac_file) for flac_file in locate(flac_dir, ext_matcher('.flac')))
-    return any(flac.info.bits_per_sample > 16 for flac in flacs)
+    return probe_release(flac_dir).is_24bit()
 
 def is_multichannel(flac_dir):
     '''
     Returns True if any FLAC within flac_dir is multichannel.
     '''
     try:
-        flacs = (mutagen.flac.FLAC(flac_file) for flac_file in locate(flac_dir, ext_matcher('.flac')))
-        return any(flac.info.channels > 2 for flac in flacs)
+        return probe_release(flac_dir).is_multichannel()
     except:
         return False
 
@@ -116,41 +203,39 @@ def resample_rate(flac_dir):
     '''
     Returns the rate to which the release should be resampled.
     '''
-    flacs = (mutagen.flac.FLAC(flac_file) for flac_file in locate(flac_dir, ext_matcher('.flac')))
-    original_rate = max(flac.info.sample_rate for flac in flacs)
-    if original_rate % 44100 == 0:
-        return 44100
-    elif original_rate % 48000 == 0:
-        return 48000
-    else:
-        return None
+    return probe_release(flac_dir).resample_rate()
+
+# Decoders write 16 bit WAV to stdout, keyed by whether resampling is
+# needed; encoders read it from stdin.
+decoder_steps = {
+    True: 'sox %(FLAC)s -G -b 16 -t wav - rate -v -L %(SAMPLERATE)s dither',
+    False: 'flac -dcs -- %(FLAC)s',
+}
+
+encoder_steps = {
+    'lame': 'lame -S %(OPTS)s - %(FILE)s',
+    'flac': 'flac %(OPTS)s -o %(FILE)s -',
+}
 
-def transcode_commands(output_format, resample, needed_sample_rate, flac_file, transcode_file):
+def encoder_opts(output_format, tag_args=None):
+    if tag_args:
+        return '%s %s' % (encoders[output_format]['opts'], tag_args)
+    return encoders[output_format]['opts']
+
+def transcode_commands(output_format, resample, needed_sample_rate, flac_file, transcode_file, tag_args=None):
     '''
     Return a list of transcode steps (one command per list element),
     which can be used to create a transcode pipeline for flac_file ->
     transcode_file using the specified output_format, plus any
-    resampling, if needed.
+    resampling, if needed. tag_args are extra encoder options that
+    write the transcode's tags (see tagging.encoder_tag_args).
     '''
-    if resample:
-        flac_decoder = 'sox %(FLAC)s -G -b 16 -t wav - rate -v -L %(SAMPLERATE)s dither'
-    else:
-        flac_decoder = 'flac -dcs -- %(FLAC)s'
-
-    lame_encoder = 'lame -S %(OPTS)s - %(FILE)s'
-    flac_encoder = 'flac %(OPTS)s -o %(FILE)s -'
-
-    transcoding_steps = [flac_decoder]
-
-    if encoders[output_format]['enc'] == 'lame':
-        transcoding_steps.append(lame_encoder)
-    elif encoders[output_format]['enc'] == 'flac':
-        transcoding_steps.append(flac_encoder)
+    transcoding_steps = [decoder_steps[resample], encoder_steps[encoders[output_format]['enc']]]
 
     transcode_args = {
         'FLAC' : pipes.quote(flac_file),
         'FILE' : pipes.quote(transcode_file),
-        'OPTS' : encoders[output_format]['opts'],
+        'OPTS' : encoder_opts(output_format, tag_args),
         'SAMPLERATE' : needed_sample_rate,
     }
 
@@ -160,19 +245,84 @@ def transcode_commands(output_format, resample, needed_sample_rate, flac_file, t
         commands = [cmd % transcode_args for cmd in transcoding_steps]
     return commands
 
+def tee_commands(output_formats, resample, needed_sample_rate, flac_file, transcode_files, tag_args=None):
+    '''
+    Return the decode command and one encode command per output format
+    for a tee pipeline, in which flac_file is decoded (and resampled, if
+    needed) once and fed to every encoder. tag_args, if given, holds the
+    tag options of each format's encoder.
+    '''
+    if tag_args is None:
+        tag_args = [None] * len(output_formats)
+    decoder = decoder_steps[resample] % {
+        'FLAC' : pipes.quote(flac_file),
+        'SAMPLERATE' : needed_sample_rate,
+    }
+    encoder_cmds = [encoder_steps[encoders[output_format]['enc']] % {
+        'FILE' : pipes.quote(transcode_file),
+        'OPTS' : encoder_opts(output_format, format_tag_args),
+    } for output_format, transcode_file, format_tag_args in zip(output_formats, transcode_files, tag_args)]
+    return decoder, encoder_cmds
+
 # Pool.map() can't pickle lambdas, so we need a helper function.
 def pool_transcode(xxx_todo_changeme):
     (flac_file, output_dir, output_format) = xxx_todo_changeme
     return transcode(flac_file, output_dir, output_format)
 
-def transcode(flac_file, output_dir, output_format):
+def pool_transcode_formats(args):
     '''
-    Transcodes a FLAC file into another format.
+    Returns the transcoded file of each output (None where it failed or
+    was skipped), what went wrong with each failed output by its
+    position, the artifact store hits and misses of this file alone, the
+    timing of the file for Metrics and, when profiling, the path of its
+    stats.
     '''
-    # gather metadata from the flac file
-    flac_info = mutagen.flac.FLAC(flac_file)
-    sample_rate = flac_info.info.sample_rate
-    bits_per_sample = flac_info.info.bits_per_sample
+    (flac_file, outputs, transcode_dirs, info, store, tags) = args
+    transcode_files = [None] * len(outputs)
+    # Don't start on the formats of a release whose transcode into them
+    # has already failed.
+    live = [i for i, transcode_dir in enumerate(transcode_dirs)
+            if not os.path.exists(os.path.join(transcode_dir, ABORT_MARKER))]
+    if not live:
+        return transcode_files, {}, 0, 0, None, []
+    timing = {
+        'start': time.time(),
+        'file': flac_file,
+        'formats': len(live),
+    }
+    # The store arrives with the totals the parent had when the task was
+    # queued, which it already has.
+    hits, misses = (store.hits, store.misses) if store else (0, 0)
+    failures = {}
+    began = time.perf_counter()
+    with profiling.worker_profile(timing) as profiles:
+        try:
+            done = transcode_formats(flac_file, [outputs[i] for i in live], info, store, tags)
+        except PartialTranscodeException as e:
+            done = e.transcode_files
+            failures = {live[i]: failure for i, failure in e.failures.items()}
+    for i, transcode_file in zip(live, done):
+        transcode_files[i] = transcode_file
+    timing.update({
+        'seconds': time.perf_counter() - began,
+        'audio_seconds': info.length if info else 0,
+        'bytes_read': os.path.getsize(flac_file),
+        'bytes_written': sum(os.path.getsize(transcode_file) for transcode_file in transcode_files if transcode_file),
+    })
+    if store:
+        hits, misses = store.hits - hits, store.misses - misses
+    return transcode_files, failures, hits, misses, timing, profiles
+
+def source_resampling(flac_file, info=None):
+    '''
+    Returns (resample, needed_sample_rate) for a FLAC file, where
+    needed_sample_rate is None if resampling isn't needed. info is the
+    file's StreamInfo, if it has already been read.
+    '''
+    if info is None:
+        info = read_streaminfo(flac_file)
+    sample_rate = info.sample_rate
+    bits_per_sample = info.bits_per_sample
     resample = sample_rate > 48000 or bits_per_sample > 16
 
     # if resampling isn't needed then needed_sample_rate will not be used.
@@ -186,14 +336,24 @@ def transcode(flac_file, output_dir, output_format):
         else:
             raise UnknownSampleRateException('FLAC file "{0}" has a sample rate {1}, which is not 88.2 , 176.4 or 96kHz but needs resampling, this is unsupported'.format(flac_file, sample_rate))
 
-    if flac_info.info.channels > 2:
+    if info.channels > 2:
         raise TranscodeDownmixException('FLAC file "%s" has more than 2 channels, unsupported' % flac_file)
 
-    # determine the new filename
+    return resample, needed_sample_rate
+
+def transcode_name(flac_file, output_dir, output_format):
+    '''Returns the path of the transcode of flac_file.'''
     transcode_basename = os.path.splitext(os.path.basename(flac_file))[0]
     transcode_basename = re.sub(r'[\?<>\\*\|"]', '_', transcode_basename)
     transcode_file = os.path.join(output_dir, transcode_basename)
-    transcode_file += encoders[output_format]['ext']
+    return transcode_file + encoders[output_format]['ext']
+
+def transcode_path(flac_file, output_dir, output_format):
+    '''
+    Returns the path of the transcode of flac_file, creating its
+    directory if needed.
+    '''
+    transcode_file = transcode_name(flac_file, output_dir, output_format)
 
     if not os.path.exists(os.path.dirname(transcode_file)):
         try:
@@ -205,50 +365,138 @@ def transcode(flac_file, output_dir, output_format):
                 pass
             else:
                 raise e
+    return transcode_file
 
-    commands = transcode_commands(output_format, resample, needed_sample_rate, flac_file, transcode_file)
-    results = run_pipeline(commands)
-
+def check_pipeline(flac_file, commands, results, output_format=None):
     # Check for problems. Because it's a pipeline, the earliest one is
     # usually the source. The exception is -SIGPIPE, which is caused
     # by "backpressure" due to a later command failing: ignore those
     # unless no other problem is found.
+    target = ' to %s' % output_format if output_format else ''
     last_sigpipe = None
     for (cmd, (code, stderr)) in zip(commands, results):
         if code:
             if code == -signal.SIGPIPE:
                 last_sigpipe = (cmd, (code, stderr))
             else:
-                raise TranscodeException('Transcode of file "%s" failed: %s' % (flac_file, stderr))
+                raise TranscodeException('Transcode of file "%s"%s failed: %s' % (flac_file, target, stderr))
     if last_sigpipe:
         # XXX: this should probably never happen....
-        raise TranscodeException('Transcode of file "%s" failed: SIGPIPE' % flac_file)
-
-    tagging.copy_tags(flac_file, transcode_file)
-    (ok, msg) = tagging.check_tags(transcode_file)
-    if not ok:
-        raise TranscodeException('Tag check failed on transcoded file: %s' % msg)
+        raise TranscodeException('Transcode of file "%s"%s failed: SIGPIPE' % (flac_file, target))
 
-    return transcode_file
+def transcode_tags(flac_file, transcode_file, tags):
+    '''
+    Returns the tags transcode_file is to be given, built from the tags
+    of flac_file, after checking them.
+    '''
+    tag_set = tagging.transcode_tags(tags, os.path.splitext(transcode_file)[1].lower())
+    problems = tagging.tag_problems(transcode_file, tag_set)
+    if problems:
+        raise TranscodeException('Tag check failed on transcoded file: %s' % problems[0])
+    return tag_set
 
-def path_length_exceeds_limit(flac_dir, basename):
-    path_length = 0;
-    flac_files = locate(flac_dir, ext_matcher('.flac'))
+def transcode(flac_file, output_dir, output_format, info=None, store=None, tags=None):
+    '''
+    Transcodes a FLAC file into another format.
+    '''
+    return transcode_formats(flac_file, [(output_dir, output_format)], info, store, tags)[0]
 
-    source_directory_name = flac_dir[flac_dir.rfind('/') + 1:-1]
+def transcode_formats(flac_file, outputs, info=None, store=None, tags=None):
+    '''
+    Transcodes a FLAC file into several formats, given as a list of
+    (output_dir, output_format) pairs, decoding it only once. Formats
+    found in the ArtifactStore store are copied from it instead. tags
+    are the FLAC's tags, if they have already been read.
 
-    for root, dirs, files in os.walk(flac_dir):
-        for name in files:
-            if len(basename + root[root.rfind(source_directory_name) + len(source_directory_name) + 1:-1] + "/" + name) > 180:
-                    return True
+    Each transcode's tags are built and checked up front, and written by
+    its encoder as it produces the file; only those it can't write, and
+    copies taken out of the store, are tagged afterwards.
 
-    return False
+    Formats are checked one by one: if some fail, the others are still
+    finished and PartialTranscodeException is raised.
+    '''
+    if info is None:
+        info = read_streaminfo(flac_file)
+    if tags is None:
+        tags = tagging.read_tags(flac_file)
+    resample, needed_sample_rate = source_resampling(flac_file, info)
+    transcode_files = [transcode_path(flac_file, output_dir, output_format)
+                       for output_dir, output_format in outputs]
+    tag_sets = [transcode_tags(flac_file, transcode_file, tags) for transcode_file in transcode_files]
+
+    pending = []
+    untagged = []
+    for (_, output_format), transcode_file, tag_set in zip(outputs, transcode_files, tag_sets):
+        key = None
+        if store:
+            key = store.key(flac_file, info, transcode_commands(output_format, resample, needed_sample_rate,
+                                                                'input.flac', 'output' + encoders[output_format]['ext']))
+            if store.fetch(key, transcode_file):
+                untagged.append((transcode_file, tag_set))
+                continue
+        # SoX resamples FLAC to FLAC by itself, without the encoder.
+        tag_args = None
+        if not (output_format == 'FLAC' and resample):
+            tag_args = tagging.encoder_tag_args(encoders[output_format]['enc'], tag_set)
+        if tag_args is None:
+            untagged.append((transcode_file, tag_set))
+        pending.append((output_format, transcode_file, key, tag_args))
+
+    failed = {}
+    if len(pending) == 1:
+        output_format, transcode_file, _, tag_args = pending[0]
+        commands = transcode_commands(output_format, resample, needed_sample_rate, flac_file, transcode_file,
+                                      tag_args)
+        results = run_pipeline(commands)
+        try:
+            check_pipeline(flac_file, commands, results)
+        except TranscodeException as e:
+            failed[transcode_file] = str(e)
+    elif pending:
+        output_formats = [output_format for output_format, _, _, _ in pending]
+        decoder, encoder_cmds = tee_commands(output_formats, resample, needed_sample_rate, flac_file,
+                                             [transcode_file for _, transcode_file, _, _ in pending],
+                                             [tag_args for _, _, _, tag_args in pending])
+        results = run_tee_pipeline(decoder, encoder_cmds)
+
+        # Each format is checked as the pipeline of the decoder and its own
+        # encoder, so a failure is reported against the format it broke.
+        for (_, transcode_file, _, _), output_format, encoder_cmd, encoder_result in zip(
+                pending, output_formats, encoder_cmds, results[1:]):
+            try:
+                check_pipeline(flac_file, [decoder, encoder_cmd], [results[0], encoder_result], output_format)
+            except TranscodeException as e:
+                failed[transcode_file] = str(e)
+
+    # Stored transcodes may carry the tags of the source they were made
+    # from; a copy taken out of the store is always retagged.
+    if store:
+        for _, transcode_file, key, _ in pending:
+            if transcode_file not in failed:
+                store.put(key, transcode_file)
+
+    for transcode_file, tag_set in untagged:
+        if transcode_file not in failed:
+            tagging.write_tags(transcode_file, tag_set)
+
+    if failed:
+        raise PartialTranscodeException(
+            [None if transcode_file in failed else transcode_file for transcode_file in transcode_files],
+            {i: failed[transcode_file] for i, transcode_file in enumerate(transcode_files) if transcode_file in failed})
+    return transcode_files
+
+def path_length_exceeds_limit(manifest, basename):
+    '''
+    Returns True if any file of the release would have a path longer than
+    the site allows once it is placed in a directory named basename.
+    '''
+    return any(len(os.path.join(basename, entry.relpath)) > 180 for entry in manifest.entries)
 
 def get_suitable_basename(basename):
 	h = html
 	return unidecode.unidecode(h.unescape(basename).replace('\\', ',').replace('/', ',').replace(':', ',').replace('*', '').replace('?', '').replace('"', '').replace('<', '').replace('>', '').replace('|', ''))
 
-def get_transcode_dir(flac_dir, output_dir, basename, output_format, resample):
+def get_transcode_dir(manifest, output_dir, basename, output_format, resample, interactive=True):
     if output_format == "FLAC":
         basename += "FLAC - Lossless"
     elif output_format == "V0":
@@ -259,20 +507,30 @@ def get_transcode_dir(flac_dir, output_dir, basename, output_format, resample):
 
     basename = get_suitable_basename(basename)
     
-    while path_length_exceeds_limit(flac_dir, basename):
+    while path_length_exceeds_limit(manifest, basename):
+        if not interactive:
+            raise PathTooLongException('the file paths in "%s" exceed the 180 character limit' % basename)
         basename = get_suitable_basename(input("The file paths in this torrent exceed the 180 character limit. \n\
-            The current directory name is: " + get_suitable_basename(basename.decode('utf-8')) + " \n\
-            Please enter a shorter directory name: ").decode('utf-8'))
+            The current directory name is: " + basename + " \n\
+            Please enter a shorter directory name: "))
 
     return os.path.join(output_dir, basename)
 
+def transcode_size(output_format, manifest, probe) -> int:
+    '''Returns at most how many bytes a release takes up in output_format.'''
+    extras = sum(entry.size for entry in manifest.files(*extra_extensions))
+    if output_format == 'FLAC':
+        return extras + sum(entry.size for entry in manifest.files('.flac'))
+    return extras + int(sum(probe[filename].length for filename in probe) * mp3_bitrate / 8)
+
 # To ensure that a terminated pool subprocess terminates its
 # children, we make each pool subprocess a process group leader,
 # and handle SIGTERM by killing the process group. This will
 # ensure there are no lingering processes when a transcode fails
 # or is interrupted.
-def pool_initializer():
+def pool_initializer(profile_dir=None):
     os.setsid()
+    profiling.start_worker(profile_dir)
     def sigterm_handler(signum, frame):
         # We're about to SIGTERM the group, including us; ignore
         # it so we can finish this handler.
@@ -283,86 +541,305 @@ def pool_initializer():
     signal.signal(signal.SIGTERM, sigterm_handler)
 
 
-def transcode_release(flac_dir, output_dir, basename, output_format, max_threads=None):
+def transcode_release(flac_dir, output_dir, basename, output_format, max_threads=None, probe=None, manifest=None,
+                      store=None):
     '''
     Transcode a FLAC release into another format.
     '''
-    flac_dir = os.path.abspath(flac_dir)
-    output_dir = os.path.abspath(output_dir)
-    flac_files = locate(flac_dir, ext_matcher('.flac'))
+    transcode_dirs = transcode_release_formats(flac_dir, output_dir, basename, [output_format], max_threads,
+                                               probe, manifest, store)
+    return transcode_dirs and transcode_dirs[output_format]
 
-    # check if we need to resample
-    resample = needs_resampling(flac_dir)
+def transcode_release_formats(flac_dir, output_dir, basename, output_formats, max_threads=None, probe=None,
+                              manifest=None, store=None):
+    '''
+    Transcode a FLAC release into several formats at once, decoding each
+    file only once. Returns a dict of the transcode directory of each
+    format, or False if only FLAC is wanted but the release doesn't
+    need to be resampled (when other formats are wanted too, FLAC is
+    left out).
+    '''
+    with TranscodePool(max_threads, store) as pool:
+        job = pool.submit(flac_dir, output_dir, basename, output_formats, probe, manifest)
+        return job and job.wait()
 
-    # check if we need to encode
-    if output_format == 'FLAC' and not resample:
-        return False
+class TranscodePool:
+    '''
+    A pool of transcode workers shared by every release in a run.
+
+    Each release is submitted as a job whose files are queued largest
+    first, so that one long track doesn't hold up the end of a release.
+    Jobs are queued behind each other, so the files of the next release
+    start on workers as soon as the current one has none left to hand
+    out, rather than when it has finished.
+
+    store is the ArtifactStore to reuse earlier transcodes from, if any,
+    and metrics the Metrics each transcoded file is recorded in. Torrents
+    of the transcodes are hashed by a thread pool in this process as the
+    files come back from the workers. With a profile_dir, workers profile
+    every file and leave the stats there. With a Staging, releases that
+    fit in it are transcoded and hashed there and only moved into
+    output_dir once they are finished.
+    '''
 
-    # make a new directory for the transcoded files
-    #
-    # NB: The cleanup code that follows this block assumes that
-    # transcode_dir is a new directory created exclusively for this
-    # transcode. Do not change this assumption without considering the
-    # consequences!
-    transcode_dir = get_transcode_dir(flac_dir, output_dir, basename, output_format, resample)
-    
-    if not os.path.exists(transcode_dir):
-        os.makedirs(transcode_dir)
-    else:
-        raise TranscodeException('transcode output directory "%s" already exists' % transcode_dir)
+    def __init__(self, max_threads=None, store=None, metrics=None, profile_dir=None, staging=None):
+        self.pool = multiprocessing.Pool(max_threads, initializer=pool_initializer,
+                                         initargs=(str(profile_dir) if profile_dir else None,))
+        self.store = store
+        self.metrics = metrics
+        self.staging = staging
+        self.hasher = ThreadPoolExecutor(torrent.HASH_THREADS)
 
-    try:
-        # create transcoding threads
-        #
-        # Use Pool.map() rather than Pool.apply_async() as it will raise
-        # exceptions synchronously. (Don't want to waste any more time
-        # when a transcode breaks.)
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.hasher.shutdown()
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.hasher.shutdown(wait=False)
+
+    def submit(self, flac_dir, output_dir, basename, output_formats, probe=None, manifest=None,
+               announce=None, piece_length=None, tags=None, interactive=True):
+        '''
+        Queues the transcodes of a release into output_formats. FLAC is
+        left out (and listed in the job's skipped) if the release doesn't
+        need to be resampled. Returns a ReleaseJob, or False if nothing
+        is left to transcode. probe and manifest are the release's
+        ReleaseProbe and ReleaseManifest, if they have already been made,
+        and tags the tags of each FLAC, if they have already been read.
+        Unless interactive, a directory name that makes the paths too long
+        raises PathTooLongException instead of asking for a shorter one.
+
+        If announce is given, the torrent of each format (with pieces of
+        2 ** piece_length bytes) is hashed as its files are finished.
+        '''
+        flac_dir = os.path.abspath(flac_dir)
+        output_dir = os.path.abspath(output_dir)
+        if manifest is None:
+            manifest = ReleaseManifest(flac_dir)
+        if probe is None:
+            probe = probe_release(flac_dir, manifest)
+        flac_files = list(probe)
+
+        # check if we need to resample
+        resample = probe.needs_resampling()
+
+        # check if we need to encode
+        skipped = []
+        if 'FLAC' in output_formats and not resample:
+            skipped = ['FLAC']
+            output_formats = [output_format for output_format in output_formats if output_format != 'FLAC']
+            if not output_formats:
+                return False
+
+        # make a new directory for the transcoded files of each format
         #
-        # XXX: actually, use Pool.map_async() and then get() the result
-        # with a large timeout, as a workaround for a KeyboardInterrupt in
-        # Pool.join(). c.f.,
-        # http://stackoverflow.com/questions/1408356/keyboard-interrupts-with-pythons-multiprocessing-pool?rq=1
-        pool = multiprocessing.Pool(max_threads, initializer=pool_initializer)
+        # NB: The cleanup code in ReleaseJob assumes that each
+        # transcode_dir is a new directory created exclusively for this
+        # transcode. Do not change this assumption without considering
+        # the consequences!
+        output_dirs = {output_format: get_transcode_dir(manifest, output_dir, basename, output_format, resample,
+                                                        interactive)
+                       for output_format in output_formats}
+        transcode_dirs = output_dirs
+        staged_size = 0
+        if self.staging is not None:
+            size = sum(transcode_size(output_format, manifest, probe) for output_format in output_formats)
+            if self.staging.reserve(size):
+                staged_size = size
+                transcode_dirs = {output_format: self.staging.path(final_dir)
+                                  for output_format, final_dir in output_dirs.items()}
+
+        for transcode_dir in list(output_dirs.values()) + list(transcode_dirs.values()):
+            if os.path.exists(transcode_dir):
+                if staged_size:
+                    self.staging.release(staged_size)
+                raise TranscodeException('transcode output directory "%s" already exists' % transcode_dir)
+        for transcode_dir in transcode_dirs.values():
+            os.makedirs(transcode_dir)
+
+        outputs = {filename: [(os.path.dirname(filename).replace(flac_dir, transcode_dir), output_format)
+                              for output_format, transcode_dir in transcode_dirs.items()]
+                   for filename in flac_files}
+
+        streams = {}
+        if announce is not None:
+            extras = [entry.relpath for entry in manifest.files(*extra_extensions)]
+            for i, (output_format, transcode_dir) in enumerate(transcode_dirs.items()):
+                relpaths = extras + [
+                    os.path.relpath(transcode_name(filename, *file_outputs[i]), transcode_dir)
+                    for filename, file_outputs in outputs.items()]
+                streams[output_format] = torrent.TorrentStream(transcode_dir, relpaths, announce, piece_length,
+                                                               self.hasher)
+
+        def finished(result):
+            # Runs on the pool's result thread, so it must not raise.
+            transcode_files, failures = result[0], result[1]
+            for i in failures:
+                # The files still queued skip the format that failed.
+                try:
+                    open(os.path.join(list(transcode_dirs.values())[i], ABORT_MARKER), 'w').close()
+                except OSError:
+                    pass
+            for stream, transcode_file in zip(streams.values(), transcode_files):
+                if transcode_file is not None:
+                    stream.add(transcode_file)
+
+        flac_files.sort(key=probe.cost, reverse=True)
+        results = [self.pool.apply_async(pool_transcode_formats, [(
+            filename,
+            outputs[filename],
+            list(transcode_dirs.values()),
+            probe[filename],
+            self.store,
+            (tags or {}).get(filename),
+        )], callback=finished) for filename in flac_files]
+        return ReleaseJob(self, manifest, transcode_dirs, results, streams, output_dirs, staged_size, skipped)
+
+class ReleaseJob:
+    '''
+    The transcodes of a release that have been queued on a TranscodePool.
+    transcode_dirs are where they are written, and output_dirs where they
+    end up, which differ if the release is staged. A format whose
+    transcode fails is dropped, with the reason kept in failures, while
+    the others go ahead. skipped are the formats that were asked for but
+    turned out not to be needed.
+    '''
+
+    def __init__(self, pool, manifest, transcode_dirs, results, streams=None, output_dirs=None, staged_size=0,
+                 skipped=None):
+        self.pool = pool
+        self.manifest = manifest
+        self.transcode_dirs = transcode_dirs
+        self.output_dirs = output_dirs if output_dirs is not None else transcode_dirs
+        self.results = results
+        self.streams = streams or {}
+        self.staged = staged_size > 0
+        self.staged_size = staged_size
+        self.published = []
+        self.failures = {}
+        self.skipped = skipped or []
+        # Stats left by profiling workers.
+        self.profiles = []
+
+    def wait(self, timeout=60 * 60 * 12):
+        '''
+        Waits for every file to be transcoded, then copies the other
+        files of the release and publishes it if it was staged. Returns
+        the output directory of each format that didn't fail; if every
+        format failed, raises.
+        '''
         try:
-            result = pool.map_async(pool_transcode, [(filename, os.path.dirname(filename).replace(flac_dir, transcode_dir), output_format) for filename in flac_files])
-            result.get(60 * 60 * 12)
-            pool.close()
-        except:
-            pool.terminate()
+            # get() rather than wait() so that a failed transcode raises
+            # here. (The timeout is also a workaround for a
+            # KeyboardInterrupt in Pool.join(). c.f.,
+            # http://stackoverflow.com/questions/1408356/keyboard-interrupts-with-pythons-multiprocessing-pool?rq=1)
+            formats = list(self.transcode_dirs)
+            for result in self.results:
+                _, failures, hits, misses, timing, profiles = result.get(timeout)
+                for i, failure in failures.items():
+                    self.failures.setdefault(formats[i], failure)
+                self.profiles.extend(profiles)
+                if self.pool.store:
+                    self.pool.store.record(hits, misses)
+                if self.pool.metrics and timing:
+                    self.pool.metrics.record('transcode_file', **timing)
+
+            for output_format in self.failures:
+                self._drop(output_format)
+            if not self.transcode_dirs:
+                raise TranscodeException(next(iter(self.failures.values())))
+
+            # copy other files
+            for entry in self.manifest.files(*extra_extensions):
+                for output_format, transcode_dir in self.transcode_dirs.items():
+                    new_dir = os.path.join(transcode_dir, os.path.dirname(entry.relpath))
+                    if not os.path.exists(new_dir):
+                        os.makedirs(new_dir)
+                    shutil.copy(entry.path, new_dir)
+                    if output_format in self.streams:
+                        self.streams[output_format].add(os.path.join(transcode_dir, entry.relpath))
+
+            if self.staged:
+                self._publish()
+
+            if self.pool.store:
+                self.pool.store.trim()
+            return self.output_dirs
+
+        except Exception:
+            # Let the files already handed to workers finish (the rest
+            # are skipped) so nothing writes to the directories after
+            # they have been removed.
+            for transcode_dir in self.transcode_dirs.values():
+                if os.path.isdir(transcode_dir):
+                    open(os.path.join(transcode_dir, ABORT_MARKER), 'w').close()
+            for result in self.results:
+                result.wait()
+            self._cleanup()
+            raise
+        except BaseException:
+            self.pool.terminate()
+            self._cleanup()
             raise
-        finally:
-            pool.join()
-
-        # copy other files
-        allowed_extensions = ['.cue', '.gif', '.jpeg', '.jpg', '.log', '.md5', '.nfo', '.pdf', '.png', '.sfv', '.txt']
-        allowed_files = locate(flac_dir, ext_matcher(*allowed_extensions))
-        for filename in allowed_files:
-            new_dir = os.path.dirname(filename).replace(flac_dir, transcode_dir)
-            if not os.path.exists(new_dir):
-                os.makedirs(new_dir)
-            shutil.copy(filename, new_dir)
-
-        return transcode_dir
 
-    except:
-        # Cleanup.
-        #
-        # ASSERT: transcode_dir was created by this function and does
-        # not contain anything other than the transcoded files!
-        shutil.rmtree(transcode_dir)
-        raise
-
-def make_torrent(input_dir, output_dir, tracker, passkey, piece_length):
-    torrent = os.path.join(output_dir, os.path.basename(input_dir)) + ".torrent"
-    if not os.path.exists(os.path.dirname(torrent)):
-        os.path.makedirs(os.path.dirname(torrent))
-    tracker_url = '%(tracker)s%(passkey)s/announce' % {
-        'tracker' : tracker,
-        'passkey' : passkey,
-    }
-    command = ["mktorrent", "-s", "RED", "-p", "-a", tracker_url, "-o", torrent, "-l", piece_length, input_dir]
-    subprocess.check_output(command, stderr=subprocess.STDOUT)
-    return torrent
+    def _drop(self, output_format):
+        # ASSERT: as in _cleanup.
+        shutil.rmtree(self.transcode_dirs.pop(output_format), ignore_errors=True)
+        self.output_dirs.pop(output_format, None)
+        self.streams.pop(output_format, None)
+
+    def _publish(self):
+        # The torrents are hashed from the staged files, so they must be
+        # finished before those are moved.
+        for output_format, transcode_dir in self.transcode_dirs.items():
+            output_dir = self.output_dirs[output_format]
+            if output_format in self.streams:
+                self.streams[output_format].settle(output_dir)
+            self.pool.staging.publish(transcode_dir, output_dir)
+            self.published.append(output_dir)
+        self._release()
+
+    def _release(self):
+        if self.staged_size:
+            self.pool.staging.release(self.staged_size)
+            self.staged_size = 0
+
+    def _cleanup(self):
+        # ASSERT: each transcode_dir (and each published output_dir) was
+        # created by this job and does not contain anything other than
+        # the transcoded files!
+        for transcode_dir in list(self.transcode_dirs.values()) + self.published:
+            shutil.rmtree(transcode_dir, ignore_errors=True)
+        self._release()
+
+def make_torrent(input_dir, output_dir, tracker, passkey, piece_length, manifest=None, stream=None):
+    '''
+    Writes the .torrent of input_dir into output_dir and returns its
+    path. If the torrent has been hashed while input_dir was transcoded,
+    stream is its TorrentStream; otherwise it is hashed now.
+    '''
+    torrent_file = os.path.join(output_dir, os.path.basename(input_dir)) + ".torrent"
+    os.makedirs(output_dir, exist_ok=True)
+    if manifest is None:
+        manifest = ReleaseManifest(input_dir)
+    metainfo = stream and stream.finish(manifest)
+    if metainfo is None:
+        metainfo = torrent.make_torrent(input_dir, torrent.announce_url(tracker, passkey), piece_length, manifest)
+    with open(torrent_file, 'wb') as f:
+        f.write(metainfo)
+    return torrent_file
 
 def main():
     import argparse
@@ -0,0 +1,27 @@
+from pathlib import Path
+
+from red_better.cache import JournaledStore
+
+# The stages in which a release can wait in the batch pipeline. Every
+# other stage runs unattended, so releases only stop where a person is
+# needed or where the work is finished.
+REVIEW = 'review'  # spectrograms made, waiting for someone to look at them
+APPROVED = 'approved'  # spectrograms accepted, waiting to be transcoded
+READY = 'ready'  # transcoded with torrents made, waiting to be uploaded
+
+
+class WorkQueue(JournaledStore):
+    '''Releases in the batch pipeline, keyed by torrent ID.'''
+
+    def __init__(self, path: Path):
+        super().__init__(path, key_type=int)
+
+    def put(self, entry):
+        self.set(entry['torrentid'], entry)
+
+    def advance(self, entry, stage):
+        entry['stage'] = stage
+        self.put(entry)
+
+    def in_stage(self, stage):
+        return [entry for entry in self.values() if entry['stage'] == stage]
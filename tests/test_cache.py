@@ -0,0 +1,52 @@
+from red_better.cache import Cache, JournaledStore, journal_path
+
+
+def tear_last_record(path):
+    '''Cuts the final journal record short, as a write killed halfway through would.'''
+    journal = journal_path(path)
+    data = journal.read_bytes()
+    journal.write_bytes(data[:-7])
+
+
+def test_journaled_store_replays_journal(tmp_path):
+    path = tmp_path / 'store'
+    store = JournaledStore(path, key_type=int)
+    store.set(1, {'group': 10})
+    store.set(2, {'group': 20})
+    store.delete(1)
+    assert journal_path(path).exists()
+
+    reloaded = JournaledStore(path, key_type=int)
+    assert dict(reloaded.items()) == {2: {'group': 20}}
+    # Loading folds the journal into the snapshot.
+    assert not journal_path(path).exists()
+
+
+def test_journaled_store_survives_torn_record(tmp_path):
+    path = tmp_path / 'store'
+    store = JournaledStore(path, key_type=int)
+    store.set(1, 'one')
+    store.set(2, 'two')
+    store.set(3, 'three')
+    tear_last_record(path)
+
+    reloaded = JournaledStore(path, key_type=int)
+    assert dict(reloaded.items()) == {1: 'one', 2: 'two'}
+    # Records appended after the torn one aren't lost with it.
+    reloaded.set(4, 'four')
+    assert dict(JournaledStore(path, key_type=int).items()) == {1: 'one', 2: 'two', 4: 'four'}
+
+
+def test_cache_survives_torn_record(tmp_path):
+    path = tmp_path / 'cache'
+    cache = Cache.from_file(path)
+    cache.add(1, 'mp3', path)
+    cache.write(path)
+    cache.add(2, 'error', path)
+    cache.add(3, 'done', path)
+    tear_last_record(path)
+
+    reloaded = Cache.from_file(path)
+    assert reloaded.ids == {1: 'mp3', 2: 'error'}
+    reloaded.add(4, 'done', path)
+    assert Cache.from_file(path).ids == {1: 'mp3', 2: 'error', 4: 'done'}
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from red_better import hashcheck, torrent
+
+FILES = {
+    '01 One.flac': 50000,
+    '02 Two.flac': 20000,
+    'cover.jpg': 12345,
+}
+PIECE_LENGTH = 14 # 16 KiB
+
+
+@pytest.fixture
+def release(tmp_path):
+    root = tmp_path / 'Artist - Album (2020) [FLAC]'
+    root.mkdir()
+    for relpath, size in FILES.items():
+        (root / relpath).write_bytes(os.urandom(size))
+    torrent_path = tmp_path / 'release.torrent'
+    torrent_path.write_bytes(torrent.make_torrent(str(root), 'announce', PIECE_LENGTH))
+    return root, torrent_path
+
+
+def corrupt(path, offset):
+    with open(str(path), 'r+b') as f:
+        f.seek(offset)
+        byte = f.read(1)
+        f.seek(offset)
+        f.write(bytes([byte[0] ^ 0xff]))
+
+
+def test_intact_release_passes(release):
+    root, torrent_path = release
+    assert hashcheck.verify(torrent_path, root) == []
+
+
+def test_corrupted_piece_is_found(release):
+    root, torrent_path = release
+    # Piece 3 spans the end of the first file and the start of the second.
+    corrupt(root / '02 Two.flac', 100)
+    failures = hashcheck.verify(torrent_path, root, threads=2)
+    assert failures == [hashcheck.HashcheckFailure(['01 One.flac', '02 Two.flac'], 'piece 3 does not match')]
+
+
+def test_truncated_file_is_found_without_hashing(release):
+    root, torrent_path = release
+    with open(str(root / 'cover.jpg'), 'r+b') as f:
+        f.truncate(100)
+    failures = hashcheck.verify(torrent_path, root)
+    assert failures == [hashcheck.HashcheckFailure(['cover.jpg'], 'is 100 bytes, expected 12345')]
+
+
+def test_cache_skips_only_unchanged_files(release, tmp_path):
+    root, torrent_path = release
+    cache = hashcheck.HashcheckCache(tmp_path / 'hashcheck')
+    assert hashcheck.verify(torrent_path, root, cache=cache) == []
+    # Same size, mtime and inode: trusted without being read again.
+    stat = os.stat(str(root / 'cover.jpg'))
+    corrupt(root / 'cover.jpg', 0)
+    os.utime(str(root / 'cover.jpg'), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert hashcheck.verify(torrent_path, root, cache=cache) == []
+    # A new mtime means the file is hashed again.
+    os.utime(str(root / 'cover.jpg'), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert hashcheck.verify(torrent_path, root, cache=cache) != []
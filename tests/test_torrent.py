@@ -0,0 +1,92 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from red_better import torrent
+
+# Sizes chosen so that pieces straddle file boundaries, including a file
+# smaller than a piece and an empty one.
+FILES = {
+    '01 One.flac': 70000,
+    '02 Two.flac': 1000,
+    'Artwork/cover.jpg': 0,
+    'Artwork/folder.jpg': 33333,
+    'info.txt': 65536,
+}
+PIECE_LENGTH = 15 # 32 KiB
+
+
+@pytest.fixture
+def release(tmp_path):
+    root = tmp_path / 'Artist - Album (2020) [FLAC]'
+    for relpath, size in FILES.items():
+        path = root / relpath
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(os.urandom(size))
+    return root
+
+
+def reference_pieces(root, piece_length):
+    data = b''.join((root / relpath).read_bytes() for relpath in sorted(FILES))
+    return b''.join(hashlib.sha1(data[i:i + piece_length]).digest()
+                    for i in range(0, len(data), piece_length))
+
+
+def test_bencode_round_trip():
+    value = {
+        'announce': 'https://flacsfor.me/passkey/announce',
+        'info': {
+            'files': [{'length': 3, 'path': ['a', 'b.flac']}],
+            'piece length': 1 << 18,
+            'pieces': bytes(range(40)),
+            'private': 1,
+        },
+        'negative': -5,
+        'list': [0, b'', [], {}],
+    }
+    encoded = torrent.bencode(value)
+    assert encoded.startswith(b'd8:announce')
+    decoded = torrent.bdecode(encoded)
+    assert decoded[b'info'][b'pieces'] == bytes(range(40))
+    assert decoded[b'info'][b'files'] == [{b'length': 3, b'path': [b'a', b'b.flac']}]
+    assert decoded[b'negative'] == -5
+    assert decoded[b'list'] == [0, b'', [], {}]
+    assert torrent.bencode(decoded) == encoded
+
+
+@pytest.mark.parametrize('data', [b'i1', b'd3:abc', b'5:abc', b'i1ee', b'x'])
+def test_bdecode_rejects_invalid_data(data):
+    with pytest.raises(torrent.BencodeError):
+        torrent.bdecode(data)
+
+
+def test_piece_hashes_cross_file_boundaries(release):
+    info = torrent.bdecode(torrent.make_torrent(str(release), 'announce', PIECE_LENGTH))[b'info']
+    assert info[b'name'] == release.name.encode()
+    assert info[b'piece length'] == 1 << PIECE_LENGTH
+    assert info[b'pieces'] == reference_pieces(release, 1 << PIECE_LENGTH)
+    assert [(b'/'.join(f[b'path']).decode(), f[b'length']) for f in info[b'files']] == sorted(FILES.items())
+
+
+def test_stream_matches_make_torrent(release):
+    with ThreadPoolExecutor(2) as executor:
+        stream = torrent.TorrentStream(str(release), [os.path.normpath(relpath) for relpath in FILES],
+                                       'announce', PIECE_LENGTH, executor)
+        # Finished out of order, as a pool of transcodes would.
+        for relpath in reversed(list(FILES)):
+            stream.add(str(release / relpath))
+        streamed = stream.finish()
+    assert streamed is not None
+    made = torrent.make_torrent(str(release), 'announce', PIECE_LENGTH)
+    assert torrent.bdecode(streamed)[b'info'] == torrent.bdecode(made)[b'info']
+
+
+def test_stream_gives_up_on_unexpected_files(release):
+    with ThreadPoolExecutor(2) as executor:
+        stream = torrent.TorrentStream(str(release), list(FILES), 'announce', PIECE_LENGTH, executor)
+        for relpath in FILES:
+            stream.add(str(release / relpath))
+        (release / 'extra.log').write_bytes(b'log')
+        assert stream.finish() is None